@@ -0,0 +1,235 @@
+'''
+Author: Denis Chernikov, B16-SE-01, Innopolis University
+
+Micro-benchmarks of MyShell internals.
+Usage: python bench.py relay [sizes in MB...] | dispatch [number of commands] | spawn [number of commands]
+                     | history [number of entries] | serve [number of commands per session]
+'''
+
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+from time import perf_counter, sleep
+from typing import Callable, Dict, List
+
+from myshell import MyShell
+from myshell_history import CommandHistory
+
+
+MB: int = 1024 * 1024
+DEFAULT_RELAY_SIZES_MB: List[int] = [1, 100, 1024]
+DEFAULT_DISPATCH_N: int = 10000
+DISPATCH_SUBPROCESS_N: int = 100
+DISPATCH_COMMANDS: List[str] = ['noop', 'pwd', 'echo hello world', 'cd .']
+DEFAULT_SPAWN_N: int = 200
+SPAWN_COMMANDS: List[str] = ['true', 'ls', 'uname -a', "printf 'a b'"]
+HISTORY_FILE_PATH: str = 'history.sqlite'
+DEFAULT_HISTORY_N: int = 200000
+HISTORY_QUERIES: List[str] = ['git', 'commit -m', 'make -j', '42', 'no such command']
+MYSHELL_PATH: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'myshell.py')
+SERVE_SOCKET_PATH: str = 'myshell.sock'
+SERVE_PROMPT_END: bytes = b']: '
+SERVE_SESSIONS: List[int] = [1, 10, 100]
+DEFAULT_SERVE_N: int = 100
+SERVE_COMMANDS: List[str] = ['echo hello', 'pwd', 'true', 'ls']
+SERVE_STARTUP_N: int = 10
+
+
+def _in_temp_dir(bench: Callable[[], None]) -> None:
+    '''
+    Run the benchmark inside a temporary CWD, so log files do not pollute the current one.
+    '''
+    old_dir = os.getcwd()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.chdir(tmp_dir)
+        try:
+            bench()
+        finally:
+            os.chdir(old_dir)
+
+
+def _shell(**params) -> MyShell:
+    '''
+    Make a shell keeping its history in the CWD.
+    '''
+    return MyShell(history_path=HISTORY_FILE_PATH, **params)
+
+
+def _silenced(func: Callable[[], None]) -> float:
+    '''
+    Call the function with `sys.stdout` redirected to the null device, return elapsed time.
+    '''
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+
+    try:
+        start = perf_counter()
+        func()
+        return perf_counter() - start
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def bench_relay(sizes_mb: List[int]) -> None:
+    '''
+    Measure throughput of the child's stdout relay for the given output sizes.
+    '''
+    shell = _shell()
+
+    for size_mb in sizes_mb:
+        args = '-c {} /dev/zero'.format(size_mb * MB)
+        elapsed = _silenced(lambda: shell._handle_subprocess('head', args))
+        print(
+            'relay {:>6} MB: {:9.3f}s, {:9.1f} MB/s'
+                .format(size_mb, elapsed, size_mb / elapsed)
+        )
+
+    shell._log_writer.close()
+
+
+def bench_dispatch(n: int) -> None:
+    '''
+    Measure per-command overhead of builtins, compared with the commands forked through the system shell.
+    '''
+    shell = _shell()
+    MyShell.register_builtin('noop', lambda shell, args: None)
+
+    def run(commands: List[str]) -> None:
+        for command in commands:
+            shell._execute_command(command)
+
+    for command in DISPATCH_COMMANDS:
+        elapsed = _silenced(lambda: run([command] * n))
+        print('builtin    {:<20}: {:9.2f}us'.format(repr(command), elapsed / n * 1e6))
+
+    for command in ['pwd', 'echo hello world']:
+        elapsed = _silenced(
+            lambda: [shell._handle_subprocess(*MyShell._separate_callee_and_args(command))
+                     for _ in range(DISPATCH_SUBPROCESS_N)]
+        )
+        print('subprocess {:<20}: {:9.2f}us'.format(repr(command), elapsed / DISPATCH_SUBPROCESS_N * 1e6))
+
+    shell._log_writer.close()
+
+
+def bench_spawn(n: int) -> None:
+    '''
+    Measure per-command startup latency of subprocesses run through the system shell and directly.
+    '''
+    shells = {
+        'shell': _shell(direct_exec=False),
+        'direct': _shell(direct_exec=True),
+    }
+
+    for command in SPAWN_COMMANDS:
+        callee, args = MyShell._separate_callee_and_args(command)
+
+        for name, shell in shells.items():
+            elapsed = _silenced(lambda: [shell._handle_subprocess(callee, args) for _ in range(n)])
+            print('{:<6} {:<16}: {:9.2f}us'.format(name, repr(command), elapsed / n * 1e6))
+
+    for shell in shells.values():
+        shell._log_writer.close()
+
+
+def bench_history(n: int) -> None:
+    '''
+    Measure adding to the history and searching in it by substrings and prefixes.
+    '''
+    history = CommandHistory(HISTORY_FILE_PATH, n)
+    templates = ['git commit -m "fix {}"', 'make -j{}', 'ls -la /tmp/dir{}', 'python script{}.py --n {}']
+
+    start = perf_counter()
+    for i in range(n):
+        history.add(templates[i % len(templates)].format(i, i * 7))
+    elapsed = perf_counter() - start
+    print('add    {:>8} entries: {:9.2f}us per entry'.format(n, elapsed / n * 1e6))
+
+    for query in HISTORY_QUERIES:
+        for name, search in [('search', history.search), ('prefix', history.prefixed)]:
+            start = perf_counter()
+            n_found = len(search(query, 20))
+            print('{} {:<18}: {:9.2f}ms, {} found'.format(name, repr(query), (perf_counter() - start) * 1e3, n_found))
+
+    history.close()
+
+
+async def _run_session(n: int) -> None:
+    '''
+    Run `n` commands in a new session of the server, each one after the previous one's prompt.
+    '''
+    reader, writer = await asyncio.open_unix_connection(SERVE_SOCKET_PATH)
+    await reader.readuntil(SERVE_PROMPT_END)
+
+    for i in range(n):
+        writer.write((SERVE_COMMANDS[i % len(SERVE_COMMANDS)] + '\n').encode())
+        await reader.readuntil(SERVE_PROMPT_END)
+
+    writer.write(b'exit\n')
+    await reader.read()
+    writer.close()
+
+
+async def _run_sessions(n_sessions: int, n: int) -> float:
+    '''
+    Run the sessions concurrently, return elapsed time.
+    '''
+    start = perf_counter()
+    await asyncio.gather(*(_run_session(n) for _ in range(n_sessions)))
+    return perf_counter() - start
+
+
+def bench_serve(n: int) -> None:
+    '''
+    Measure throughput of the server for the numbers of concurrent sessions,
+    compared with starting an interpreter per session.
+    '''
+    start = perf_counter()
+    for _ in range(SERVE_STARTUP_N):
+        subprocess.run(
+            [sys.executable, MYSHELL_PATH, '--batch', os.devnull],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        )
+    print('interpreter per session: {:9.2f}ms startup'.format((perf_counter() - start) / SERVE_STARTUP_N * 1e3))
+
+    server = subprocess.Popen([sys.executable, MYSHELL_PATH, '--serve', SERVE_SOCKET_PATH])
+
+    try:
+        while not os.path.exists(SERVE_SOCKET_PATH):
+            if server.poll() is not None:
+                raise RuntimeError('server exited with code {}'.format(server.returncode))
+            sleep(0.01)
+
+        for n_sessions in SERVE_SESSIONS:
+            elapsed = asyncio.run(_run_sessions(n_sessions, n))
+            print(
+                'serve {:>4} sessions: {:9.1f} commands/s, {:9.2f}ms per session start to exit'
+                    .format(n_sessions, n_sessions * n / elapsed, elapsed / n_sessions * 1e3)
+            )
+    finally:
+        server.send_signal(signal.SIGINT)
+        server.wait()
+
+
+BENCHMARKS: Dict[str, Callable[[List[str]], None]] = {
+    'relay': lambda argv: bench_relay(list(map(int, argv)) or DEFAULT_RELAY_SIZES_MB),
+    'dispatch': lambda argv: bench_dispatch(int(argv[0]) if argv else DEFAULT_DISPATCH_N),
+    'spawn': lambda argv: bench_spawn(int(argv[0]) if argv else DEFAULT_SPAWN_N),
+    'history': lambda argv: bench_history(int(argv[0]) if argv else DEFAULT_HISTORY_N),
+    'serve': lambda argv: bench_serve(int(argv[0]) if argv else DEFAULT_SERVE_N),
+}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print(__doc__.strip().splitlines()[-1])
+        sys.exit(1)
+
+    _in_temp_dir(lambda: BENCHMARKS[sys.argv[1]](sys.argv[2:]))
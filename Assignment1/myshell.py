@@ -1,197 +1,2077 @@
-'''
-Author: Denis Chernikov, B16-SE-01, Innopolis University
-'''
-
-from datetime import datetime
-from enum import Enum
-import os
-import subprocess
-import sys
-from typing import Optional, Tuple
-
-
-class CustomCommands(Enum):
-    CHANGE_DIR = 'cd'
-    EXIT = 'exit'
-
-
-class MyShell():
-    SHELL_NAME: str = 'myshell'
-    LOG_FILE_PATH: str = SHELL_NAME + '.log'
-    ERR_FILE_PATH: str = SHELL_NAME + '.stderr'
-    CHANGE_DIR_ERROR_MSG: bytes = b'The system cannot find the path specified.\n'
-    EXIT_MESSAGE: bytes = b'Goodbye!\n'
-
-
-    def __init__(self):
-        self._exited: bool = False
-
-
-    def _shorten_path(path: str) -> str:
-        '''
-        Cut every section in the file path down to 1 character (or 2 if starts with '.').
-        '''
-        return os.sep.join(
-            map(
-                lambda substr: substr[:2] if substr[0] == '.' else substr[0],
-                os.path.normpath(path).split(os.sep),
-            )
-        )
-
-
-    def _get_prompt() -> str:
-        '''
-        Get the prompt text of MyShell.
-        '''
-        return (
-            '{} [{}]: '
-                .format(MyShell.SHELL_NAME, MyShell._shorten_path(os.getcwd()))
-        )
-
-
-    def _separate_callee_and_args(command: str) -> Tuple[str, Optional[str]]:
-        '''
-        Separate the command into the callee and it's arguments.
-        '''
-        res = command.strip().split(' ', 1)
-
-        while len(res) < 2:
-            res.append(None)
-
-        return tuple(res)
-
-
-    def _log_action(callee: str, args: str, stdout: bytes, pid: int, exit_code: int, cwd: str = '') -> None:
-        '''
-        Write an action info into the log file.
-
-        Note: if a file should be placed somewhere else than the CWD, pass the `cwd` argument.
-        '''
-        with open(os.path.join(cwd, MyShell.LOG_FILE_PATH), 'ab') as log_file:
-            log_file.write(
-                '[{}]\n* cmd: {}\n* args: {}\n* pid: {}\n* exit: {}\n* stdout:\n'
-                    .format(datetime.utcnow(), callee, args, pid, exit_code).encode()
-            )
-            log_file.write(stdout)
-            log_file.write(b'\n=========================\n')
-
-
-    def _handle_subprocess(callee: str, args: str) -> None:
-        '''
-        Run given callee as a subprocess, handle it's output streams and log it.
-
-        Note: `stderr` stream will be written to the corresponding file in CWD.
-        '''
-        cmd_proc = subprocess.Popen(
-            ' '.join([callee, args]) if args else callee,
-            shell=True,
-            stdin=sys.stdin,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
-
-        out_bytes = b''
-
-        while True:
-            out_char = cmd_proc.stdout.read(1)  # Less efficient, but more flexible
-            out_bytes += out_char
-            sys.stdout.buffer.write(out_char)
-
-            if out_char == b'' and cmd_proc.poll() is not None:
-                break
-
-        err_bytes = cmd_proc.stderr.read()
-        if err_bytes:
-            with open(MyShell.ERR_FILE_PATH, 'ab') as err_file:
-                err_file.write(err)
-
-        MyShell._log_action(
-            callee,
-            args,
-            out_bytes,
-            cmd_proc.pid,
-            cmd_proc.poll(),
-        )
-
-
-    def _execute_cd(path: str) -> None:
-        '''
-        Execute `cd` command (will change CWD) and log it.
-
-        Note: logging will be done into the previous CWD's log.
-        '''
-        success: bool = True
-        old_dir: str = os.getcwd()
-
-        if path:
-            try:
-                os.chdir(path)
-            except FileNotFoundError:
-                sys.stdout.buffer.write(MyShell.CHANGE_DIR_ERROR_MSG)
-                success = False
-
-        MyShell._log_action(
-            CustomCommands.CHANGE_DIR.value,
-            path,
-            b'' if success else MyShell.CHANGE_DIR_ERROR_MSG,
-            None,
-            0 if success else 1,
-            old_dir,
-        )
-
-
-    def _execute_exit(self) -> None:
-        '''
-        Execute `exit` command (will set exit flag for the shell) and log it.
-
-        Note: sets `_exited` flag.
-        '''
-        sys.stdout.buffer.write(MyShell.EXIT_MESSAGE)
-        # exit()  # Not recommended to use because caller will terminate too
-        self._exited = True
-
-        MyShell._log_action(
-            CustomCommands.EXIT.value,
-            None,
-            MyShell.EXIT_MESSAGE,
-            None,
-            None,
-        )
-
-
-    def _execute_command(self, command: str) -> None:
-        '''
-        Execute the given command.
-
-        Note: command will be logged if this functionality is implemented for the command.
-        '''
-        callee, args = MyShell._separate_callee_and_args(command)
-
-        try:
-            {
-                CustomCommands.CHANGE_DIR: lambda: MyShell._execute_cd(args),
-                CustomCommands.EXIT: self._execute_exit,
-            }[CustomCommands(callee)]()
-        except (KeyError, ValueError):
-            MyShell._handle_subprocess(callee, args)
-
-
-    def run(self) -> None:
-        '''
-        Run MyShell's main loop.
-
-        Note: loop breaks on `_exited` flag set.
-        '''
-        while not self._exited:
-            try:
-                self._execute_command(input(MyShell._get_prompt()))
-
-            except (EOFError, KeyboardInterrupt):
-                self._execute_exit()
-                break
-
-        self._exited = False
-
-
-if __name__ == '__main__':
-    MyShell().run()
+'''
+Author: Denis Chernikov, B16-SE-01, Innopolis University
+'''
+
+import argparse
+import asyncio
+import atexit
+import heapq
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import nullcontext
+from datetime import datetime
+from enum import Enum
+from functools import lru_cache
+import os
+import queue
+import re
+import selectors
+import shlex
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+from time import monotonic, perf_counter
+from typing import Awaitable, BinaryIO, Callable, Dict, List, Optional, Pattern, Tuple, Union
+
+from myshell_history import CommandHistory, install_readline
+from myshell_log import LogEntry, LogFormat, ResourceUsage, entry_size
+
+
+class CustomCommands(Enum):
+    CHANGE_DIR = 'cd'
+    EXIT = 'exit'
+    PRINT_DIR = 'pwd'
+    ECHO = 'echo'
+    EXPORT = 'export'
+    HISTORY = 'history'
+    TIME = 'time'
+    HASH = 'hash'
+    JOBS = 'jobs'
+    STATS = 'stats'
+    FOREGROUND = 'fg'
+    BACKGROUND = 'bg'
+    WAIT = 'wait'
+
+
+class CapturePolicy(Enum):
+    '''
+    What to keep of a command's stdout for the log once it exceeds the capture limit.
+    '''
+    HEAD_TAIL = 'head-tail'  # Keep only the first and the last halves of the limit in memory
+    SPILL = 'spill'  # Keep everything, but move it from memory to a temporary file
+
+
+class _OutputCapture():
+    '''
+    Sink of a relayed stream: passes chunks to the destination and captures them for the log
+    according to the capture policy, so memory use never exceeds the capture limit.
+    '''
+
+    def __init__(self, dst: Optional[BinaryIO], policy: CapturePolicy, limit: int):
+        self._dst: Optional[BinaryIO] = dst
+        self._policy: CapturePolicy = policy
+        self.total: int = 0
+
+        if policy is CapturePolicy.SPILL:
+            self._spill: BinaryIO = tempfile.SpooledTemporaryFile(limit)
+        else:
+            self._head: bytearray = bytearray()
+            self._head_limit: int = limit - limit // 2
+            self._tail: bytearray = bytearray(limit // 2)  # Ring buffer
+            self._tail_pos: int = 0
+            self._tail_len: int = 0
+
+
+    def write(self, data: memoryview) -> None:
+        if self._dst is not None:
+            self._dst.write(data)
+            self._dst.flush()
+
+        self.total += len(data)
+
+        if self._policy is CapturePolicy.SPILL:
+            self._spill.write(data)
+            return
+
+        if len(self._head) < self._head_limit:
+            n_head = self._head_limit - len(self._head)
+            self._head += data[:n_head]
+            data = data[n_head:]
+
+        if data:
+            self._keep_tail(data)
+
+
+    def _keep_tail(self, data: memoryview) -> None:
+        capacity = len(self._tail)
+
+        if not capacity:
+            return
+        if len(data) >= capacity:
+            self._tail[:] = data[len(data) - capacity:]
+            self._tail_pos = 0
+        else:
+            n_first = min(len(data), capacity - self._tail_pos)
+            self._tail[self._tail_pos:self._tail_pos + n_first] = data[:n_first]
+            self._tail[:len(data) - n_first] = data[n_first:]
+            self._tail_pos = (self._tail_pos + len(data)) % capacity
+
+        self._tail_len = min(capacity, self._tail_len + len(data))
+
+
+    def parts(self) -> List[object]:
+        '''
+        Get the captured data as a list of log entry parts (byte strings and files to copy from).
+        Omitted data is marked with the number of bytes omitted.
+        '''
+        if self._policy is CapturePolicy.SPILL:
+            self._spill.seek(0)
+            return [self._spill]
+
+        res = [bytes(self._head)]
+        omitted = self.total - len(self._head) - self._tail_len
+
+        if omitted:
+            res.append(MyShell.LOG_TRUNCATED_MSG.format(omitted).encode())
+        if self._tail_len == len(self._tail):
+            res.append(bytes(self._tail[self._tail_pos:]) + bytes(self._tail[:self._tail_pos]))
+        else:
+            res.append(bytes(self._tail[:self._tail_len]))
+
+        return res
+
+
+class _AppendSink():
+    '''
+    Sink of a relayed stream appending chunks to a file, which is opened on the first chunk only.
+    '''
+
+    def __init__(self, path: str):
+        self._path: str = path
+        self._file: Optional[BinaryIO] = None
+
+
+    def write(self, data: memoryview) -> None:
+        if self._file is None:
+            self._file = open(self._path, 'ab')
+
+        self._file.write(data)
+        self._file.flush()
+
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+
+
+class _Stage():
+    '''
+    Single command of a pipeline with its redirections.
+    '''
+
+    def __init__(self, callee: str, args: Optional[str], argv: List[str]):
+        self.callee: str = callee
+        self.args: Optional[str] = args
+        self.argv: List[str] = argv
+        self.executable: Optional[str] = None
+        self.redirects: Dict[int, Tuple[str, str]] = {}  # fd -> (path, open mode)
+
+
+class _Job():
+    '''
+    Started pipeline: its stages, processes and output sinks.
+    '''
+
+    def __init__(self, command: str, stages: List[_Stage], cwd: str):
+        self.id: Optional[int] = None  # Assigned to background jobs only
+        self.command: str = command
+        self.stages: List[_Stage] = stages
+        self.cwd: str = cwd
+        self.procs: List[Optional[subprocess.Popen]] = []
+        self.sinks: Dict[BinaryIO, object] = {}
+        self.out_capture: Optional['_OutputCapture'] = None
+        self.err_sink: Optional[_AppendSink] = None
+        self.runner: object = None  # Thread or asyncio task relaying the background job
+        self.done: threading.Event = threading.Event()  # Set once the background job is finished and logged
+        self.start_time: float = 0.0
+        self.usages: List[Optional[ResourceUsage]] = []
+
+
+    def send_signal(self, signum: int) -> None:
+        for proc in self.procs:
+            if proc is not None and proc.returncode is None:
+                try:
+                    proc.send_signal(signum)
+                except ProcessLookupError:
+                    pass
+
+
+    def is_done(self) -> bool:
+        return self.done.is_set()
+
+
+    def is_stopped(self) -> bool:
+        '''
+        Check if any of the job's processes is stopped (e.g. by SIGSTOP).
+
+        Note: processes are not reaped by the check.
+        '''
+        for proc in self.procs:
+            if proc is None or proc.returncode is not None:
+                continue
+
+            try:
+                if os.waitid(os.P_PID, proc.pid, os.WSTOPPED | os.WNOHANG | os.WNOWAIT) is not None:
+                    return True
+            except ChildProcessError:  # Already reaped
+                pass
+
+        return False
+
+
+class _UsageStats():
+    '''
+    Aggregated resource usage of the commands: totals and the top commands by every metric.
+
+    Note: only the top commands are kept, so memory use does not grow with the number of commands.
+    Max RSS of a command is never below the forked shell's one, so small commands are not told apart by it.
+    '''
+    METRICS: Dict[str, Callable[[ResourceUsage], float]] = {
+        'slowest (wall time, s)': lambda usage: usage.wall,
+        'CPU-heaviest (user + sys time, s)': lambda usage: usage.user + usage.sys,
+        'memory-heaviest (max RSS, KiB, including the shell\'s memory before exec)': lambda usage: usage.max_rss,
+        'I/O-heaviest (bytes read + written)': lambda usage: usage.read_bytes + usage.written_bytes,
+    }
+
+
+    def __init__(self, top_size: int):
+        self._top_size: int = top_size
+        self._tops: Dict[str, List[Tuple[float, int, str]]] = {metric: [] for metric in _UsageStats.METRICS}
+        self._n_commands: int = 0
+        self._total_wall: float = 0.0
+        self._total_cpu: float = 0.0
+        self._lock: threading.Lock = threading.Lock()
+
+
+    def add(self, command: str, usage: ResourceUsage) -> None:
+        with self._lock:
+            self._n_commands += 1
+            self._total_wall += usage.wall
+            self._total_cpu += usage.user + usage.sys
+
+            for metric, get_value in _UsageStats.METRICS.items():
+                item = (get_value(usage), self._n_commands, command)  # Number breaks ties
+                if len(self._tops[metric]) < self._top_size:
+                    heapq.heappush(self._tops[metric], item)
+                else:
+                    heapq.heappushpop(self._tops[metric], item)
+
+
+    def render(self) -> str:
+        with self._lock:
+            lines = [
+                '{} commands, {:.3f}s wall time, {:.3f}s CPU time in total'
+                    .format(self._n_commands, self._total_wall, self._total_cpu),
+            ]
+
+            for metric, top in self._tops.items():
+                lines.append('')
+                lines.append('Top {}:'.format(metric))
+                lines += ['{:>14g}  {}'.format(value, command) for value, _, command in sorted(top, reverse=True)]
+
+            return '\n'.join(lines) + '\n'
+
+
+class _ActionLogWriter():
+    '''
+    Writer of log entries working in a background thread.
+
+    Entries are put into a bounded queue and written in batches (group commit):
+    a batch is written once it has `flush_size` bytes or its first entry is `flush_interval` seconds old.
+    Log files stay open between batches.
+    '''
+    _STOP: object = object()
+    _FLUSH: object = object()
+
+
+    def __init__(self, log_format: LogFormat, flush_interval: float, flush_size: int, queue_size: int):
+        self._log_format: LogFormat = log_format
+        self._flush_interval: float = flush_interval
+        self._flush_size: int = flush_size
+        self._queue: queue.Queue = queue.Queue(queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self._lock: threading.Lock = threading.Lock()
+
+
+    def write(self, path: str, entry: LogEntry) -> None:
+        '''
+        Enqueue the entry to be appended to the log file by given path.
+
+        Note: blocks while the queue is full.
+        Note: the entry is enqueued under the lock, so it is not left behind the stop mark of a concurrent `close`.
+        '''
+        with self._lock:
+            if self._thread is None:
+                atexit.register(self.close)
+            self._start_thread()
+
+            self._queue.put((path, entry))
+
+
+    def _start_thread(self) -> None:
+        '''
+        Start the background thread if it is not running (not started yet or died), so the queue is consumed.
+        '''
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='myshell-log', daemon=True)
+            self._thread.start()
+
+
+    def close(self) -> None:
+        '''
+        Write all the enqueued entries and stop the background thread.
+
+        Note: writer may be used again after closing, the thread will be restarted.
+        '''
+        with self._lock:
+            if self._thread is None:
+                return
+
+            self._start_thread()
+            self._queue.put(_ActionLogWriter._STOP)
+            self._thread.join()
+            self._thread = None
+            atexit.unregister(self.close)
+
+
+    def _run(self) -> None:
+        files: Dict[str, object] = {}
+        batch: List[Tuple[str, LogEntry]] = []
+        batch_size: int = 0
+        deadline: Optional[float] = None
+
+        try:
+            while True:
+                try:
+                    item = self._queue.get(
+                        timeout=None if deadline is None else max(0, deadline - monotonic())
+                    )
+                except queue.Empty:
+                    item = _ActionLogWriter._FLUSH
+
+                if item is not _ActionLogWriter._STOP and item is not _ActionLogWriter._FLUSH:
+                    batch.append(item)
+                    batch_size += entry_size(item[1])
+
+                    if deadline is None:
+                        deadline = monotonic() + self._flush_interval
+                    if batch_size < self._flush_size and monotonic() < deadline:
+                        continue
+
+                self._commit(files, batch)
+                batch, batch_size, deadline = [], 0, None
+
+                if item is _ActionLogWriter._STOP:
+                    break
+        finally:
+            for log_file in files.values():
+                log_file.close()
+
+
+    def _commit(self, files: Dict[str, object], batch: List[Tuple[str, LogEntry]]) -> None:
+        '''
+        Append the entries to their log files and flush them.
+
+        Note: an entry which fails to be written is reported and skipped, the thread goes on with the rest.
+        '''
+        touched = set()
+
+        for path, entry in batch:
+            try:
+                if path not in files:
+                    files[path] = self._log_format.value(path)
+
+                files[path].append(entry)
+                touched.add(path)
+            except Exception as e:
+                sys.stderr.write('{}: cannot write log {}: {}\n'.format(MyShell.SHELL_NAME, path, e))
+
+        for path in touched:
+            try:
+                files[path].flush()
+            except Exception as e:
+                sys.stderr.write('{}: cannot write log {}: {}\n'.format(MyShell.SHELL_NAME, path, e))
+
+
+class MyShell():
+    SHELL_NAME: str = 'myshell'
+    LOG_FILE_PATH: str = SHELL_NAME + '.log'
+    BINARY_LOG_FILE_PATH: str = LOG_FILE_PATH + '.bin'
+    ERR_FILE_PATH: str = SHELL_NAME + '.stderr'
+    CHANGE_DIR_ERROR_MSG: bytes = b'The system cannot find the path specified.\n'
+    EXIT_MESSAGE: bytes = b'Goodbye!\n'
+    SHELL_SPECIAL_CHARS: frozenset = frozenset('|&;<>()$`*?[]{}~#\n')
+    SHELL_OPERATOR_CHARS: frozenset = frozenset('|&;<>()`')
+    VARIABLE_REFERENCE: Pattern = re.compile(r'\$(?:([A-Za-z_][A-Za-z0-9_]*)|\{([A-Za-z_][A-Za-z0-9_]*)\})')
+    SYSTEM_SHELL: str = '/bin/sh'
+    PIPE_OPERATOR: str = '|'
+    REDIRECT_OPERATORS: Dict[str, Tuple[int, str]] = {  # Longest first
+        '2>>': (2, 'ab'),
+        '2>': (2, 'wb'),
+        '>>': (1, 'ab'),
+        '>': (1, 'wb'),
+        '<': (0, 'rb'),
+    }
+    RELAY_CHUNK_SIZE: int = 64 * 1024
+    CAPTURE_LIMIT: int = 1024 * 1024
+    LOG_TRUNCATED_MSG: str = '\n... [{} bytes are not logged] ...\n'
+    LOG_FLUSH_INTERVAL: float = 1.0
+    LOG_FLUSH_SIZE: int = 64 * 1024
+    LOG_QUEUE_SIZE: int = 1024
+    PROMPT_CACHE_SIZE: int = 64
+    HISTORY_FILE_PATH: str = os.path.join(os.path.expanduser('~'), '.' + SHELL_NAME + '_history.sqlite')
+    HISTORY_SIZE: int = 100000
+    HISTORY_READLINE_PRELOAD: int = 1000
+    HISTORY_SEARCH_LIMIT: int = 20
+    STATS_TOP_SIZE: int = 10
+    PROC_IO_PATH: str = '/proc/{}/io'
+    RUSAGE_BLOCK_SIZE: int = 512
+
+
+    def __init__(
+        self,
+        log_flush_interval: float = LOG_FLUSH_INTERVAL,
+        log_flush_size: int = LOG_FLUSH_SIZE,
+        capture_policy: CapturePolicy = CapturePolicy.HEAD_TAIL,
+        capture_limit: int = CAPTURE_LIMIT,
+        log_format: LogFormat = LogFormat.TEXT,
+        direct_exec: bool = True,
+        prompt: bool = True,
+        history_path: str = HISTORY_FILE_PATH,
+        stdin: object = None,
+        output: Optional[BinaryIO] = None,
+        log_writer: Optional['_ActionLogWriter'] = None,
+    ):
+        '''
+        Note: `stdin` (stdin by default) is passed to foreground commands, `output` receives everything the shell
+        prints itself (stdout and error messages of the shell, stdout of commands); stdout by default.
+        Note: `log_writer` may be shared by several shells, so a log file is written by one thread only,
+        it is not closed by the shell then.
+        '''
+        self._exited: bool = False
+        self._cwd: str = os.getcwd()  # Tracked by `cd` for the shell only, the process' CWD is not changed
+        self._prompt: bool = prompt
+        self._stdin: object = sys.stdin if stdin is None else stdin
+        self._output: Optional[BinaryIO] = output
+        self._history: CommandHistory = CommandHistory(history_path, MyShell.HISTORY_SIZE)
+        self._direct_exec: bool = direct_exec
+        self._path_cache: Dict[str, str] = {}
+        self._path_cache_env: Optional[str] = None
+        self._jobs: Dict[int, _Job] = {}
+        self._stats: _UsageStats = _UsageStats(MyShell.STATS_TOP_SIZE)
+        self._children_changed: bool = False  # Set by the threads reaping background jobs on their finish
+        self._capture_policy: CapturePolicy = capture_policy
+        self._capture_limit: int = capture_limit
+        self._log_file_path: str = (
+            MyShell.BINARY_LOG_FILE_PATH if log_format is LogFormat.BINARY else MyShell.LOG_FILE_PATH
+        )
+        self._owns_log_writer: bool = log_writer is None
+        self._log_writer: _ActionLogWriter = log_writer or _ActionLogWriter(
+            log_format,
+            log_flush_interval,
+            log_flush_size,
+            MyShell.LOG_QUEUE_SIZE,
+        )
+
+
+    def _stdout(self) -> BinaryIO:
+        '''
+        Get the stream to print to (the current stdout, unless the shell has its own output).
+        '''
+        return sys.stdout.buffer if self._output is None else self._output
+
+
+    def _write_err(self, text: str) -> None:
+        '''
+        Print an error message of the shell (to stderr, unless the shell has its own output).
+        '''
+        if self._output is None:
+            sys.stderr.write(text)
+        else:
+            self._output.write(text.encode())
+            self._output.flush()
+
+
+    @lru_cache(maxsize=PROMPT_CACHE_SIZE)
+    def _shorten_path(path: str) -> str:
+        '''
+        Cut every section in the file path down to 1 character (or 2 if starts with '.').
+
+        Note: results are cached, since the same few paths are shortened for every prompt.
+        '''
+        return os.sep.join(
+            map(
+                lambda substr: substr[:2] if substr[:1] == '.' else substr[:1],
+                os.path.normpath(path).split(os.sep),
+            )
+        )
+
+
+    def _get_prompt(self) -> str:
+        '''
+        Get the prompt text of MyShell (empty if the prompt is disabled).
+        '''
+        if not self._prompt:
+            return ''
+
+        return (
+            '{} [{}]: '
+                .format(MyShell.SHELL_NAME, MyShell._shorten_path(self._cwd))
+        )
+
+
+    def _separate_callee_and_args(command: str) -> Tuple[str, Optional[str]]:
+        '''
+        Separate the command into the callee and it's arguments.
+        '''
+        res = command.strip().split(' ', 1)
+
+        while len(res) < 2:
+            res.append(None)
+
+        return tuple(res)
+
+
+    def _log_action(
+        self,
+        callee: str,
+        args: str,
+        stdout: Union[bytes, _OutputCapture],
+        pid: int,
+        exit_code: int,
+        cwd: Optional[str] = None,
+        usage: Optional[ResourceUsage] = None,
+    ) -> None:
+        '''
+        Write an action info into the log file.
+
+        Note: if a file should be placed somewhere else than the shell's CWD, pass the `cwd` argument.
+        Note: writing is done in the background, entries are guaranteed to be written on `exit`.
+        Note: resource usage (if given) is also added to the session statistics.
+        '''
+        if usage is not None:
+            self._stats.add(' '.join([callee, args]) if args else callee, usage)
+
+        if isinstance(stdout, _OutputCapture):
+            stdout_parts, stdout_size = stdout.parts(), stdout.total
+        else:
+            stdout_parts, stdout_size = [stdout], None
+
+        self._log_writer.write(
+            os.path.abspath(os.path.join(self._cwd if cwd is None else cwd, self._log_file_path)),
+            LogEntry(datetime.utcnow(), callee, args, pid, exit_code, stdout_parts, stdout_size, usage),
+        )
+
+
+    def _pump_streams(sinks: Dict[BinaryIO, object]) -> None:
+        '''
+        Relay given pipes to their sinks (objects with `write`) until all of them are closed.
+
+        Note: pipes are multiplexed with a selector, so every chunk is passed on as soon as it arrives
+        and no pipe is left full while waiting on another one.
+        Note: pipes are read with `readinto` into a single reusable buffer, so no data is copied per chunk.
+        '''
+        chunk = bytearray(MyShell.RELAY_CHUNK_SIZE)
+        chunk_view = memoryview(chunk)
+
+        with selectors.DefaultSelector() as selector:
+            for pipe, sink in sinks.items():
+                selector.register(pipe, selectors.EVENT_READ, sink)
+
+            while selector.get_map():
+                for key, _ in selector.select():
+                    n_read = key.fileobj.readinto(chunk)
+                    if not n_read:
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
+                        continue
+
+                    key.data.write(chunk_view[:n_read])
+
+
+    def _resolve_executable(self, name: str) -> Optional[str]:
+        '''
+        Find the executable by the name in PATH, remembering found ones until PATH changes or `hash -r`.
+        '''
+        path_env = os.environ.get('PATH', os.defpath)
+        if path_env != self._path_cache_env:
+            self._path_cache.clear()
+            self._path_cache_env = path_env
+
+        executable = self._path_cache.get(name)
+
+        if executable is None:
+            executable = shutil.which(name, path=path_env)
+            if executable is not None:
+                self._path_cache[name] = executable
+
+        return executable
+
+
+    def _tokenize(command: str) -> Optional[List[Tuple[bool, str]]]:
+        '''
+        Split the command into words and operators (pipes and redirections), marked with `True`.
+        Quotes and backslashes are handled as the system shell does.
+
+        Note: `None` is returned if any other shell syntax is used.
+        '''
+        operators = [MyShell.PIPE_OPERATOR] + list(MyShell.REDIRECT_OPERATORS)
+        tokens = []
+        word = None  # Not started yet, differs from an empty quoted word
+        i = 0
+
+        def end_word() -> None:
+            nonlocal word
+            if word is not None:
+                tokens.append((False, word))
+                word = None
+
+        while i < len(command):
+            char = command[i]
+
+            if char == '\'':
+                end = command.find('\'', i + 1)
+                if end < 0:
+                    return None
+                word = (word or '') + command[i + 1:end]
+                i = end + 1
+
+            elif char == '"':
+                part = ''
+                i += 1
+                while i < len(command) and command[i] != '"':
+                    if command[i] in '$`':
+                        return None
+                    if command[i] == '\\' and command[i + 1:i + 2] in ('"', '\\'):
+                        i += 1
+                    part += command[i]
+                    i += 1
+                if i == len(command):
+                    return None
+                word = (word or '') + part
+                i += 1
+
+            elif char == '\\':
+                if i + 1 == len(command) or command[i + 1] == '\n':
+                    return None
+                word = (word or '') + command[i + 1]
+                i += 2
+
+            elif char.isspace() and char != '\n':
+                end_word()
+                i += 1
+
+            else:
+                operator = next(
+                    (
+                        op for op in operators
+                        if command.startswith(op, i) and (word is None or not op[0].isdigit())
+                    ),
+                    None,
+                )
+
+                if operator is not None:
+                    end_word()
+                    tokens.append((True, operator))
+                    i += len(operator)
+                elif char in MyShell.SHELL_SPECIAL_CHARS:
+                    return None
+                else:
+                    word = (word or '') + char
+                    i += 1
+
+        end_word()
+        return tokens
+
+
+    def _split_assignments(args: str) -> List[str]:
+        '''
+        Split arguments of `export` into words as the system shell does,
+        expanding `$NAME` and `${NAME}` outside of single quotes (unset variables are empty).
+
+        Note: `ValueError` is raised on unbalanced quotes and on other shell syntax
+        (command substitution, special parameters, operators), since it is not supported.
+        '''
+        words = []
+        word = None  # Not started yet, differs from an empty quoted word
+        i = 0
+
+        def expand(i: int) -> Tuple[str, int]:
+            match = MyShell.VARIABLE_REFERENCE.match(args, i)
+            if match is not None:
+                return os.environ.get(match.group(1) or match.group(2), ''), match.end()
+            if i + 1 == len(args) or args[i + 1] == '"' or args[i + 1].isspace():  # Literal `$`
+                return '$', i + 1
+            raise ValueError('unsupported syntax: {}'.format(args[i:i + 2]))
+
+        while i < len(args):
+            char = args[i]
+
+            if char == '\'':
+                end = args.find('\'', i + 1)
+                if end < 0:
+                    raise ValueError('No closing quotation')
+                word = (word or '') + args[i + 1:end]
+                i = end + 1
+
+            elif char == '"':
+                part = ''
+                i += 1
+                while i < len(args) and args[i] != '"':
+                    if args[i] == '$':
+                        value, i = expand(i)
+                        part += value
+                        continue
+                    if args[i] == '`':
+                        raise ValueError('unsupported syntax: `')
+                    if args[i] == '\\' and args[i + 1:i + 2] in ('"', '\\', '$', '`'):
+                        i += 1
+                    part += args[i]
+                    i += 1
+                if i == len(args):
+                    raise ValueError('No closing quotation')
+                word = (word or '') + part
+                i += 1
+
+            elif char == '\\':
+                if i + 1 == len(args):
+                    raise ValueError('No escaped character')
+                word = (word or '') + args[i + 1]
+                i += 2
+
+            elif char.isspace():
+                if word is not None:
+                    words.append(word)
+                    word = None
+                i += 1
+
+            elif char == '$':
+                value, i = expand(i)
+                word = (word or '') + value
+
+            elif char in MyShell.SHELL_OPERATOR_CHARS:
+                raise ValueError('unsupported syntax: {}'.format(char))
+
+            else:
+                word = (word or '') + char
+                i += 1
+
+        if word is not None:
+            words.append(word)
+        return words
+
+
+    def _parse_pipeline(command: str) -> Optional[List[_Stage]]:
+        '''
+        Parse the command into pipeline stages.
+
+        Note: `None` is returned if the command cannot be executed without the system shell.
+        '''
+        tokens = MyShell._tokenize(command)
+        if not tokens:
+            return None
+
+        stages = []
+        words = []
+        redirects = {}
+        texts = []
+
+        tokens.append((True, MyShell.PIPE_OPERATOR))  # Terminates the last stage
+        tokens_iter = iter(tokens)
+
+        for is_operator, token in tokens_iter:
+            if not is_operator:
+                words.append(token)
+                texts.append(shlex.quote(token))
+                continue
+
+            if token != MyShell.PIPE_OPERATOR:
+                is_operator, target = next(tokens_iter, (True, None))
+                if is_operator:  # No word to redirect to
+                    return None
+                redirects[MyShell.REDIRECT_OPERATORS[token][0]] = (target, MyShell.REDIRECT_OPERATORS[token][1])
+                texts.append(token + shlex.quote(target))
+                continue
+
+            if not words or '=' in words[0]:  # Empty stage or variable assignment
+                return None
+
+            stage = _Stage(words[0], ' '.join(texts[1:]) or None, words)
+            stage.redirects = redirects
+            stages.append(stage)
+            words, redirects, texts = [], {}, []
+
+        return stages
+
+
+    def _close_stream(stream: Union[int, BinaryIO]) -> None:
+        if isinstance(stream, int):
+            os.close(stream)
+        else:
+            stream.close()
+
+
+    def _start_job(
+        self,
+        job: _Job,
+        stdin: object,
+        shell_argv: Optional[List[str]] = None,
+        detach: bool = False,
+        out_dst: Optional[BinaryIO] = None,
+    ) -> None:
+        '''
+        Start the job's pipeline, reading `stdin` in the first stage and relaying its output to `out_dst`
+        (stdout by default).
+
+        Note: stages are connected with OS pipes directly, their data does not pass through MyShell.
+        Note: if a stage cannot be started, it is started with `shell_argv` if given,
+        otherwise the error is written to stderr file and the stage has no process.
+        Note: `detach` starts processes in a new session, so terminal signals do not reach them.
+        '''
+        job.out_capture = _OutputCapture(
+            self._stdout() if out_dst is None else out_dst,
+            self._capture_policy,
+            self._capture_limit,
+        )
+        job.err_sink = _AppendSink(os.path.join(job.cwd, MyShell.ERR_FILE_PATH))
+        job.start_time = perf_counter()
+        next_stdin = stdin
+        to_close = []
+
+        try:
+            for i, stage in enumerate(job.stages):
+                streams = [next_stdin, subprocess.PIPE, subprocess.PIPE]
+                next_stdin = subprocess.DEVNULL
+
+                if i + 1 < len(job.stages):
+                    next_stdin, streams[1] = os.pipe()
+                    to_close += [next_stdin, streams[1]]
+
+                for fd, (path, mode) in stage.redirects.items():
+                    try:
+                        streams[fd] = open(os.path.join(job.cwd, path), mode)
+                    except OSError as e:
+                        streams[fd] = None
+                        job.err_sink.write(
+                            memoryview('{}: {}: {}\n'.format(MyShell.SHELL_NAME, path, e.strerror).encode())
+                        )
+                        break
+                    to_close.append(streams[fd])
+
+                proc = None
+                if None not in streams:
+                    for argv, executable in [(stage.argv, stage.executable), (shell_argv, None)]:
+                        try:
+                            proc = subprocess.Popen(
+                                argv,
+                                executable=executable,
+                                bufsize=0,  # Raw pipes, so `readinto` does exactly one read per call
+                                stdin=streams[0],
+                                stdout=streams[1],
+                                stderr=streams[2],
+                                cwd=job.cwd,
+                                start_new_session=detach,
+                            )
+                            break
+                        except OSError as e:
+                            self._path_cache.pop(stage.callee, None)  # Might be stale
+                            if shell_argv is None:
+                                job.err_sink.write(
+                                    memoryview('{}: {}: {}\n'.format(MyShell.SHELL_NAME, stage.callee, e.strerror).encode())
+                                )
+                                break
+
+                job.procs.append(proc)
+
+                if proc is not None:
+                    if proc.stdout is not None:
+                        job.sinks[proc.stdout] = job.out_capture
+                    if proc.stderr is not None:
+                        job.sinks[proc.stderr] = job.err_sink
+
+                # Parent's copies of the stage's streams are not needed anymore
+                for stream in [stream for stream in to_close if stream != next_stdin]:
+                    to_close.remove(stream)
+                    MyShell._close_stream(stream)
+        except BaseException:
+            for stream in to_close + list(job.sinks):
+                MyShell._close_stream(stream)
+            job.err_sink.close()
+            raise
+
+
+    def _finish_job(self, job: _Job) -> None:
+        '''
+        Relay the job's output streams and wait for all of its stages to finish.
+        '''
+        try:
+            MyShell._pump_streams(job.sinks)
+        finally:
+            job.err_sink.close()
+
+        job.usages = [None if proc is None else MyShell._wait_child(proc, job.start_time) for proc in job.procs]
+
+
+    def _read_proc_io(pid: int) -> Optional[Tuple[int, int]]:
+        '''
+        Get the numbers of bytes read and written by the process (including pipes and terminal) from procfs.
+        '''
+        try:
+            with open(MyShell.PROC_IO_PATH.format(pid)) as io_file:
+                counters = dict(line.split(': ', 1) for line in io_file.read().splitlines())
+            return int(counters['rchar']), int(counters['wchar'])
+        except (OSError, KeyError, ValueError):
+            return None
+
+
+    def _wait_child(proc: subprocess.Popen, start_time: float) -> Optional[ResourceUsage]:
+        '''
+        Wait for the process to exit, reap it and get its resource usage (including its waited-for children).
+
+        Note: bytes read and written are taken from procfs before reaping,
+        otherwise (without procfs) only block I/O is counted.
+        '''
+        try:
+            os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)  # Zombie stays, so its procfs entry does
+            wall = perf_counter() - start_time
+            io_counters = MyShell._read_proc_io(proc.pid)
+            _, status, rusage = os.wait4(proc.pid, 0)
+        except ChildProcessError:  # Reaped by someone else
+            proc.wait()
+            return None
+
+        proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+
+        if io_counters is None:
+            io_counters = (rusage.ru_inblock * MyShell.RUSAGE_BLOCK_SIZE, rusage.ru_oublock * MyShell.RUSAGE_BLOCK_SIZE)
+
+        return ResourceUsage(wall, rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss, *io_counters)
+
+
+    def _log_job(self, job: _Job) -> None:
+        '''
+        Log every stage of the finished job.
+        '''
+        for i, (stage, proc, usage) in enumerate(zip(job.stages, job.procs, job.usages)):
+            self._log_action(
+                stage.callee,
+                stage.args,
+                job.out_capture if i + 1 == len(job.stages) else b'',
+                None if proc is None else proc.pid,
+                1 if proc is None else proc.returncode,
+                job.cwd,
+                usage,
+            )
+
+
+    def _prepare_job(self, callee: str, args: Optional[str]) -> Tuple[_Job, Optional[List[str]]]:
+        '''
+        Make a job for the command, with pipeline stages to be executed directly if possible,
+        otherwise with a single stage executed by the system shell.
+        Also return the system shell's arguments to fall back to if a single command cannot be executed directly.
+        '''
+        command = ' '.join([callee, args]) if args else callee
+        shell_stages = [_Stage(callee, args, [MyShell.SYSTEM_SHELL, '-c', command])]
+        stages = MyShell._parse_pipeline(command) if self._direct_exec else None
+
+        for stage in stages or []:
+            stage.executable = stage.argv[0] if os.sep in stage.argv[0] else self._resolve_executable(stage.argv[0])
+            if stage.executable is None:
+                stages = None
+                break
+
+        if stages is None:
+            return _Job(command, shell_stages, self._cwd), None
+
+        # Single command which cannot be executed directly (e.g. script without shebang) goes to the system shell
+        return _Job(command, stages, self._cwd), shell_stages[0].argv if len(stages) == 1 else None
+
+
+    def _handle_subprocess(self, callee: str, args: str, background: bool = False) -> None:
+        '''
+        Run given callee as a subprocess, handle it's output streams and log it.
+
+        Note: pipelines and redirections without other shell syntax are executed directly,
+        other commands go to the system shell. Every stage of a pipeline is logged separately.
+        Note: `stderr` stream will be written to the corresponding file in CWD.
+        Note: background jobs do not read stdin, their output is relayed and logged by a separate thread.
+        '''
+        job, shell_argv = self._prepare_job(callee, args)
+        self._start_job(
+            job,
+            subprocess.DEVNULL if background else self._stdin,
+            shell_argv,
+            detach=background,
+        )
+
+        if not background:
+            self._finish_job(job)
+            self._log_job(job)
+            return
+
+        self._add_background_job(job, threading.Thread(target=self._run_background_job, args=(job,), daemon=True))
+        job.runner.start()
+
+
+    def _add_background_job(self, job: _Job, runner: object) -> None:
+        '''
+        Assign an ID to the started background job, remember it with its runner and print it.
+        '''
+        job.id = max(self._jobs, default=0) + 1
+        job.runner = runner
+        self._jobs[job.id] = job
+
+        self._stdout().write(
+            '[{}] {}\n'.format(job.id, ' '.join(str(proc.pid) for proc in job.procs if proc is not None)).encode()
+        )
+        self._stdout().flush()
+
+
+    def _run_background_job(self, job: _Job) -> None:
+        try:
+            self._finish_job(job)
+            self._log_job(job)
+        finally:
+            job.done.set()
+            self._children_changed = True
+
+
+    def _report_done_jobs(self) -> None:
+        '''
+        Print finished background jobs and forget them.
+        '''
+        if not self._children_changed:
+            return
+
+        self._children_changed = False
+
+        for job_id, job in list(self._jobs.items()):
+            if job.is_done():
+                del self._jobs[job_id]
+                self._stdout().write('[{}]  Done\t{}\n'.format(job_id, job.command).encode())
+
+        self._stdout().flush()
+
+
+    def _wait_job(self, job: _Job) -> None:
+        '''
+        Wait for the background job to finish and forget it.
+
+        Note: interruption (Ctrl-C) is passed to the job's processes.
+        '''
+        while not job.is_done():
+            try:
+                job.done.wait()
+            except KeyboardInterrupt:
+                job.send_signal(signal.SIGINT)
+
+        self._jobs.pop(job.id, None)
+
+
+    async def _wait_job_async(self, job: _Job) -> None:
+        '''
+        Wait for the background job to finish and forget it, without blocking the event loop or its executor
+        (the job's processes are reaped in the executor, so waiting there could take all of its threads).
+        '''
+        if isinstance(job.runner, asyncio.Future):
+            await asyncio.wait([job.runner])
+        else:  # Relayed by a thread, its end is waited for by another one
+            loop = asyncio.get_running_loop()
+            done = loop.create_future()
+
+            def wait() -> None:
+                job.done.wait()
+                loop.call_soon_threadsafe(lambda: done.done() or done.set_result(None))
+
+            threading.Thread(target=wait, name='myshell-wait', daemon=True).start()
+            await done
+
+        self._jobs.pop(job.id, None)
+
+
+    def _execute_cd(self, path: str) -> None:
+        '''
+        Execute `cd` command (will change CWD) and log it.
+
+        Note: logging will be done into the previous CWD's log.
+        Note: `..` is resolved logically (against the path used to get to the CWD, not the physical one).
+        Note: only the shell's CWD is changed, so shells sharing a process do not affect each other.
+        '''
+        success: bool = True
+        old_dir: str = self._cwd
+
+        if path:
+            new_dir = os.path.normpath(os.path.join(old_dir, path))
+            if os.path.isdir(new_dir) and os.access(new_dir, os.X_OK):
+                self._cwd = new_dir
+            else:
+                self._stdout().write(MyShell.CHANGE_DIR_ERROR_MSG)
+                self._stdout().flush()
+                success = False
+
+        self._log_action(
+            CustomCommands.CHANGE_DIR.value,
+            path,
+            b'' if success else MyShell.CHANGE_DIR_ERROR_MSG,
+            None,
+            0 if success else 1,
+            old_dir,
+        )
+
+
+    def _execute_exit(self, args: Optional[str] = None) -> None:
+        '''
+        Execute `exit` command (will set exit flag for the shell) and log it.
+
+        Note: sets `_exited` flag.
+        Note: waits for background jobs, so their output is logged.
+        '''
+        for job in list(self._jobs.values()):
+            self._wait_job(job)
+
+        self._finish_exit(args)
+
+
+    def _finish_exit(self, args: Optional[str]) -> None:
+        '''
+        Finish `exit` command once background jobs are finished.
+        '''
+        self._stdout().write(MyShell.EXIT_MESSAGE)
+        self._stdout().flush()
+        # exit()  # Not recommended to use because caller will terminate too
+        self._exited = True
+
+        self._log_action(
+            CustomCommands.EXIT.value,
+            args,
+            MyShell.EXIT_MESSAGE,
+            None,
+            None,
+        )
+        if self._owns_log_writer:
+            self._log_writer.close()
+        self._history.close()
+
+
+    def _execute_output_builtin(self, callee: str, args: Optional[str], out: bytes, exit_code: int = 0) -> None:
+        '''
+        Finish a builtin command producing the given output: print and log it.
+        '''
+        self._stdout().write(out)
+        self._stdout().flush()
+        self._log_action(callee, args, out, None, exit_code)
+
+
+    def _execute_pwd(self, args: Optional[str]) -> None:
+        '''
+        Execute `pwd` command (will print CWD) and log it.
+        '''
+        self._execute_output_builtin(CustomCommands.PRINT_DIR.value, args, (self._cwd + '\n').encode())
+
+
+    def _execute_echo(self, args: Optional[str]) -> None:
+        '''
+        Execute `echo` command (will print the arguments unquoted) and log it.
+
+        Note: used for arguments without options and backslashes only (see `_find_builtin`).
+        '''
+        self._execute_output_builtin(
+            CustomCommands.ECHO.value,
+            args,
+            (' '.join(shlex.split(args or '')) + '\n').encode(),
+        )
+
+
+    def _execute_export(self, args: Optional[str]) -> None:
+        '''
+        Execute `export` command (will set environment variables for subsequent commands) and log it.
+
+        Note: `$NAME` is expanded outside of single quotes (see `_split_assignments`),
+        without arguments all the variables are printed.
+        '''
+        if not args:
+            out = ''.join(
+                'export {}={}\n'.format(name, shlex.quote(value)) for name, value in sorted(os.environ.items())
+            )
+            self._execute_output_builtin(CustomCommands.EXPORT.value, args, out.encode())
+            return
+
+        try:
+            assignments = MyShell._split_assignments(args)
+        except ValueError as e:  # Unbalanced quotes or unsupported syntax
+            out = '{}: export: {}\n'.format(MyShell.SHELL_NAME, e)
+            self._execute_output_builtin(CustomCommands.EXPORT.value, args, out.encode(), 1)
+            return
+
+        out = ''
+        for assignment in assignments:
+            name, sep, value = assignment.partition('=')
+
+            if not name.isidentifier():
+                out += '{}: export: `{}\': not a valid identifier\n'.format(MyShell.SHELL_NAME, assignment)
+            elif sep:
+                os.environ[name] = value
+
+        self._execute_output_builtin(CustomCommands.EXPORT.value, args, out.encode(), 1 if out else 0)
+
+
+    def _execute_history(self, args: Optional[str]) -> None:
+        '''
+        Execute `history` command and log it:
+        * `history [N]` will print all (or the last N) commands entered;
+        * `history -s TEXT` will print the latest commands containing the text;
+        * `history -p PREFIX` will print the latest distinct commands starting with the prefix.
+        '''
+        option, _, text = (args or '').strip().partition(' ')
+        exit_code = 0
+
+        if option == '-s':
+            entries = self._history.search(text, MyShell.HISTORY_SEARCH_LIMIT)
+        elif option == '-p':
+            entries = [(None, command) for command in self._history.prefixed(text, MyShell.HISTORY_SEARCH_LIMIT)]
+        elif not option or option.isdigit():
+            entries = self._history.recent(int(option) if option else None)
+        else:
+            entries = [(None, '{}: history: {}: invalid option'.format(MyShell.SHELL_NAME, option))]
+            exit_code = 1
+
+        out = ''.join(
+            '{:5}  {}\n'.format(number, command) if number is not None else command + '\n'
+            for number, command in entries
+        )
+        self._execute_output_builtin(CustomCommands.HISTORY.value, args, out.encode(), exit_code)
+
+
+    def _execute_time(self, args: Optional[str]) -> None:
+        '''
+        Execute `time` command (will execute the given command and print time spent to stderr).
+        '''
+        start_times = os.times()
+        start = perf_counter()
+
+        if args:
+            self._dispatch(*MyShell._separate_callee_and_args(args))
+
+        self._report_time(start, start_times)
+
+
+    def _report_time(self, start: float, start_times: os.times_result) -> None:
+        '''
+        Print time spent since the given `perf_counter()` and `os.times()` to stderr.
+        '''
+        elapsed = perf_counter() - start
+        end_times = os.times()
+
+        self._write_err(
+            '\nreal\t{:.3f}s\nuser\t{:.3f}s\nsys\t{:.3f}s\n'.format(
+                elapsed,
+                end_times.user + end_times.children_user - start_times.user - start_times.children_user,
+                end_times.system + end_times.children_system - start_times.system - start_times.children_system,
+            )
+        )
+
+
+    def _execute_hash(self, args: Optional[str]) -> None:
+        '''
+        Execute `hash` command (will print, reset with `-r` or fill the PATH lookup cache) and log it.
+        '''
+        try:
+            names = shlex.split(args or '')
+        except ValueError as e:  # Unbalanced quotes
+            out = '{}: hash: {}\n'.format(MyShell.SHELL_NAME, e)
+            self._execute_output_builtin(CustomCommands.HASH.value, args, out.encode(), 1)
+            return
+
+        out = ''
+        exit_code = 0
+
+        if '-r' in names:
+            self._path_cache.clear()
+        elif names:
+            for name in names:
+                if self._resolve_executable(name) is None:
+                    out += '{}: hash: {}: not found\n'.format(MyShell.SHELL_NAME, name)
+                    exit_code = 1
+        else:
+            out = ''.join('{}\t{}\n'.format(name, path) for name, path in sorted(self._path_cache.items()))
+
+        self._execute_output_builtin(CustomCommands.HASH.value, args, out.encode(), exit_code)
+
+
+    def _find_job(self, builtin: CustomCommands, args: Optional[str]) -> Optional[_Job]:
+        '''
+        Find the job by its ID (`N` or `%N`) or the latest one if not given, print error if there is no such job.
+        '''
+        job_id = (args or '').strip().lstrip('%')
+
+        if not job_id and self._jobs:
+            return self._jobs[max(self._jobs)]
+        if job_id.isdigit() and int(job_id) in self._jobs:
+            return self._jobs[int(job_id)]
+
+        self._write_err('{}: {}: {}: no such job\n'.format(MyShell.SHELL_NAME, builtin.value, job_id or 'current'))
+        return None
+
+
+    def _execute_jobs(self, args: Optional[str]) -> None:
+        '''
+        Execute `jobs` command (will print background jobs with their states) and log it.
+        '''
+        out = ''.join(
+            '[{}]  {}\t{}\n'.format(
+                job_id,
+                'Done' if job.is_done() else 'Stopped' if job.is_stopped() else 'Running',
+                job.command,
+            )
+            for job_id, job in sorted(self._jobs.items())
+        )
+        self._execute_output_builtin(CustomCommands.JOBS.value, args, out.encode())
+
+
+    def _execute_fg(self, args: Optional[str]) -> None:
+        '''
+        Execute `fg` command (will continue the job if stopped and wait for it) and log it.
+
+        Note: the job keeps not reading stdin.
+        '''
+        job = self._find_job(CustomCommands.FOREGROUND, args)
+        if job is not None:
+            self._stdout().write((job.command + '\n').encode())
+            self._stdout().flush()
+            job.send_signal(signal.SIGCONT)
+            self._wait_job(job)
+
+        self._log_action(CustomCommands.FOREGROUND.value, args, b'', None, 0 if job else 1)
+
+
+    def _execute_bg(self, args: Optional[str]) -> None:
+        '''
+        Execute `bg` command (will continue the stopped job in background) and log it.
+        '''
+        job = self._find_job(CustomCommands.BACKGROUND, args)
+        if job is not None:
+            job.send_signal(signal.SIGCONT)
+
+        self._log_action(CustomCommands.BACKGROUND.value, args, b'', None, 0 if job else 1)
+
+
+    def _execute_wait(self, args: Optional[str]) -> None:
+        '''
+        Execute `wait` command (will wait for the given or all background jobs) and log it.
+        '''
+        jobs = list(self._jobs.values()) if not args else [self._find_job(CustomCommands.WAIT, args)]
+
+        for job in jobs:
+            if job is not None:
+                self._wait_job(job)
+
+        self._log_action(CustomCommands.WAIT.value, args, b'', None, 0 if None not in jobs else 1)
+
+
+    def _execute_stats(self, args: Optional[str]) -> None:
+        '''
+        Execute `stats` command (will print resource usage of the session's subprocesses) and log it.
+        '''
+        self._execute_output_builtin(CustomCommands.STATS.value, args, self._stats.render().encode())
+
+
+    def _is_simple(args: Optional[str]) -> bool:
+        '''
+        Check if the arguments use no shell syntax except of quotes, so the command may run without a shell.
+        '''
+        if not args:
+            return True
+        if not MyShell.SHELL_SPECIAL_CHARS.isdisjoint(args):
+            return False
+
+        try:
+            shlex.split(args)
+        except ValueError:  # Unbalanced quotes
+            return False
+
+        return True
+
+
+    def register_builtin(name: str, handler: Callable[['MyShell', Optional[str]], None], fast_path: bool = False) -> None:
+        '''
+        Register a command to be executed in-process by `handler(shell, args)`.
+
+        Note: fast path builtins are used only if the arguments use no shell syntax,
+        otherwise the command goes to the system shell.
+        '''
+        MyShell._BUILTINS.pop(name, None)
+        MyShell._FAST_PATH_BUILTINS.pop(name, None)
+        MyShell._ASYNC_BUILTINS.pop(name, None)
+        (MyShell._FAST_PATH_BUILTINS if fast_path else MyShell._BUILTINS)[name] = handler
+
+
+    def _split_builtin_pipeline(
+        callee: str,
+        args: Optional[str],
+    ) -> Optional[Tuple[Optional[str], Dict[int, Tuple[str, str]], Optional[str]]]:
+        '''
+        Split the command of a builtin which only prints (see `_OUTPUT_BUILTINS`), if it has pipes or redirections,
+        into the builtin's arguments, its redirections and the rest of the pipeline (if any).
+
+        Note: `None` is returned for other commands, commands with other shell syntax and `export` with assignments.
+        '''
+        if callee not in MyShell._OUTPUT_BUILTINS or MyShell._is_simple(args):
+            return None
+
+        stages = MyShell._parse_pipeline(' '.join([callee, args]))
+        if stages is None:
+            return None
+
+        words = stages[0].argv[1:]
+        if callee == CustomCommands.EXPORT.value and words:
+            return None
+
+        rest = ' | '.join(
+            ' '.join([shlex.quote(stage.argv[0])] + ([stage.args] if stage.args else [])) for stage in stages[1:]
+        )
+        return ' '.join(shlex.quote(word) for word in words) or None, stages[0].redirects, rest or None
+
+
+    def _start_builtin_pipeline(
+        self,
+        builtin: Callable[['MyShell', Optional[str]], None],
+        args: Optional[str],
+        redirects: Dict[int, Tuple[str, str]],
+        rest: Optional[str],
+    ) -> Optional[_Job]:
+        '''
+        Run the builtin with its output written to the file it is redirected to, or passed to the rest
+        of the pipeline (see `_split_builtin_pipeline`), which is started as a job (returned).
+
+        Note: the builtin's output is collected first, only stdout redirection is applied to it.
+        '''
+        out_file = tempfile.TemporaryFile()
+        output = self._output
+        self._output = out_file
+
+        try:
+            builtin(self, args)
+        finally:
+            self._output = output
+
+        with out_file:
+            out_file.seek(0)
+
+            if 1 in redirects:  # Nothing is passed to the rest of the pipeline then
+                path, mode = redirects[1]
+                try:
+                    with open(os.path.join(self._cwd, path), mode) as dst:
+                        shutil.copyfileobj(out_file, dst, MyShell.RELAY_CHUNK_SIZE)
+                except OSError as e:
+                    self._write_err('{}: {}: {}\n'.format(MyShell.SHELL_NAME, path, e.strerror))
+                out_file.seek(0)
+                out_file.truncate()
+
+            if rest is None:
+                return None
+
+            job, shell_argv = self._prepare_job(*MyShell._separate_callee_and_args(rest))
+            self._start_job(job, out_file, shell_argv)
+            return job
+
+
+    def _find_builtin(callee: str, args: Optional[str]) -> Optional[Callable[['MyShell', Optional[str]], None]]:
+        '''
+        Get the builtin to execute the command by, if there is one for it.
+
+        Note: builtins which only print go to the system shell if their arguments have shell syntax
+        other than pipes and redirections (see `_split_builtin_pipeline`), except of `export`,
+        which may have assignments.
+        '''
+        builtin = MyShell._BUILTINS.get(callee)
+
+        if (
+            builtin is not None
+            and callee in MyShell._OUTPUT_BUILTINS
+            and callee != CustomCommands.EXPORT.value
+            and not MyShell._is_simple(args)
+            and MyShell._split_builtin_pipeline(callee, args) is None
+        ):
+            return None
+
+        if builtin is None:
+            builtin = MyShell._FAST_PATH_BUILTINS.get(callee)
+            if builtin is not None and not MyShell._is_simple(args):
+                builtin = None
+            # Options and escapes of `echo` are left to the system one
+            if callee == CustomCommands.ECHO.value and args and (args.lstrip().startswith('-') or '\\' in args):
+                builtin = None
+
+        return builtin
+
+
+    def _dispatch(self, callee: str, args: Optional[str]) -> None:
+        '''
+        Execute the command by a builtin if there is one for it, otherwise as a subprocess.
+        '''
+        builtin = MyShell._find_builtin(callee, args)
+        pipeline = None if builtin is None else MyShell._split_builtin_pipeline(callee, args)
+
+        if builtin is None:
+            self._handle_subprocess(callee, args)
+        elif pipeline is not None:
+            job = self._start_builtin_pipeline(builtin, *pipeline)
+            if job is not None:
+                self._finish_job(job)
+                self._log_job(job)
+        else:
+            builtin(self, args)
+
+
+    def _parse_command(self, command: str) -> Tuple[str, Optional[str], bool]:
+        '''
+        Add the command to the history and separate it into the callee, it's arguments
+        and whether it should run in background (ends with `&`).
+        '''
+        if command.strip():
+            self._history.add(command)
+        stripped = command.rstrip()
+
+        if stripped.endswith('&') and not stripped.endswith('&&'):
+            callee, args = MyShell._separate_callee_and_args(stripped[:-1])
+            if callee:
+                return callee, args, True
+
+        return MyShell._separate_callee_and_args(command) + (False,)
+
+
+    def _execute_command(self, command: str) -> None:
+        '''
+        Execute the given command.
+
+        Note: command will be logged if this functionality is implemented for the command.
+        Note: command ending with `&` is started as a background job, builtins are not used for it.
+        '''
+        callee, args, background = self._parse_command(command)
+
+        if background:
+            self._handle_subprocess(callee, args, background=True)
+        else:
+            self._dispatch(callee, args)
+
+
+    async def _relay_stream(
+        pipe: BinaryIO,
+        sink: object,
+        drain: Optional[Callable[[], Awaitable[None]]] = None,
+    ) -> None:
+        '''
+        Relay the pipe to the sink (object with `write`) until it is closed, through an asyncio stream.
+
+        Note: `drain` (if given) is awaited after every chunk, so a slow destination slows the relay down
+        instead of buffering the whole output.
+        '''
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader(MyShell.RELAY_CHUNK_SIZE)
+        transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+
+        try:
+            while True:
+                data = await reader.read(MyShell.RELAY_CHUNK_SIZE)
+                if not data:
+                    break
+                sink.write(memoryview(data))
+                if drain is not None:
+                    await drain()
+        finally:
+            transport.close()  # Closes the pipe too
+
+
+    async def _finish_job_async(self, job: _Job) -> None:
+        '''
+        Relay the job's output streams and wait for all of its stages to finish, without blocking the event loop.
+
+        Note: processes are reaped in the loop's executor by `_wait_child`, so their resource usage is known
+        (`asyncio` child watchers reap them by `waitpid`, which loses it).
+        '''
+        loop = asyncio.get_running_loop()
+
+        async def wait_child(proc: Optional[subprocess.Popen]) -> Optional[ResourceUsage]:
+            if proc is None:
+                return None
+            return await loop.run_in_executor(None, MyShell._wait_child, proc, job.start_time)
+
+        drain = getattr(self._output, 'drain', None)
+
+        try:
+            await asyncio.gather(*(
+                MyShell._relay_stream(pipe, sink, drain if sink is job.out_capture else None)
+                for pipe, sink in job.sinks.items()
+            ))
+        finally:
+            job.err_sink.close()
+
+        job.usages = list(await asyncio.gather(*(wait_child(proc) for proc in job.procs)))
+
+
+    async def _run_background_job_async(self, job: _Job) -> None:
+        try:
+            await self._finish_job_async(job)
+            self._log_job(job)
+        finally:
+            job.done.set()
+            self._children_changed = True
+
+
+    async def _execute_exit_async(self, args: Optional[str] = None) -> None:
+        for job in list(self._jobs.values()):
+            await self._wait_job_async(job)
+
+        self._finish_exit(args)
+
+
+    async def _execute_time_async(self, args: Optional[str]) -> None:
+        start_times = os.times()
+        start = perf_counter()
+
+        if args:
+            await self._dispatch_async(*MyShell._separate_callee_and_args(args))
+
+        self._report_time(start, start_times)
+
+
+    async def _execute_fg_async(self, args: Optional[str]) -> None:
+        job = self._find_job(CustomCommands.FOREGROUND, args)
+        if job is not None:
+            self._stdout().write((job.command + '\n').encode())
+            self._stdout().flush()
+            job.send_signal(signal.SIGCONT)
+            await self._wait_job_async(job)
+
+        self._log_action(CustomCommands.FOREGROUND.value, args, b'', None, 0 if job else 1)
+
+
+    async def _execute_wait_async(self, args: Optional[str]) -> None:
+        jobs = list(self._jobs.values()) if not args else [self._find_job(CustomCommands.WAIT, args)]
+
+        for job in jobs:
+            if job is not None:
+                await self._wait_job_async(job)
+
+        self._log_action(CustomCommands.WAIT.value, args, b'', None, 0 if None not in jobs else 1)
+
+
+    async def execute_async(self, command: str) -> None:
+        '''
+        Execute the given command without blocking the event loop, so the shell can be embedded into asyncio
+        applications: output of subprocesses and background jobs is relayed by the loop's tasks.
+
+        Note: builtins run on the loop's thread, the ones waiting for jobs or commands (see `_ASYNC_BUILTINS`)
+        await them on the loop.
+        '''
+        await self._dispatch_async(*self._parse_command(command))
+
+
+    async def _dispatch_async(self, callee: str, args: Optional[str], background: bool = False) -> None:
+        '''
+        Execute the command by a builtin if there is one for it, otherwise as a subprocess, without blocking the loop.
+        '''
+        builtin = None if background else MyShell._find_builtin(callee, args)
+        pipeline = None if builtin is None else MyShell._split_builtin_pipeline(callee, args)
+
+        if pipeline is not None:
+            job = self._start_builtin_pipeline(builtin, *pipeline)
+            if job is not None:
+                await self._finish_job_async(job)
+                self._log_job(job)
+            return
+
+        if builtin is not None:
+            async_builtin = MyShell._ASYNC_BUILTINS.get(callee)
+            if async_builtin is not None:
+                await async_builtin(self, args)
+            else:
+                builtin(self, args)
+            return
+
+        job, shell_argv = self._prepare_job(callee, args)
+        self._start_job(
+            job,
+            subprocess.DEVNULL if background else self._stdin,
+            shell_argv,
+            detach=background,
+        )
+
+        if background:
+            self._add_background_job(job, asyncio.ensure_future(self._run_background_job_async(job)))
+        else:
+            await self._finish_job_async(job)
+            self._log_job(job)
+
+
+    # Precomputed dispatch tables, see `register_builtin`
+    _BUILTINS: Dict[str, Callable[['MyShell', Optional[str]], None]] = {
+        CustomCommands.CHANGE_DIR.value: _execute_cd,
+        CustomCommands.EXIT.value: _execute_exit,
+        CustomCommands.EXPORT.value: _execute_export,
+        CustomCommands.HISTORY.value: _execute_history,
+        CustomCommands.TIME.value: _execute_time,
+        CustomCommands.HASH.value: _execute_hash,
+        CustomCommands.JOBS.value: _execute_jobs,
+        CustomCommands.FOREGROUND.value: _execute_fg,
+        CustomCommands.BACKGROUND.value: _execute_bg,
+        CustomCommands.WAIT.value: _execute_wait,
+        CustomCommands.STATS.value: _execute_stats,
+    }
+    _FAST_PATH_BUILTINS: Dict[str, Callable[['MyShell', Optional[str]], None]] = {
+        CustomCommands.PRINT_DIR.value: _execute_pwd,
+        CustomCommands.ECHO.value: _execute_echo,
+    }
+    _ASYNC_BUILTINS: Dict[str, Callable[['MyShell', Optional[str]], Awaitable[None]]] = {
+        CustomCommands.EXIT.value: _execute_exit_async,
+        CustomCommands.TIME.value: _execute_time_async,
+        CustomCommands.FOREGROUND.value: _execute_fg_async,
+        CustomCommands.WAIT.value: _execute_wait_async,
+    }  # Versions of the builtins used by `execute_async`
+    _OUTPUT_BUILTINS: frozenset = frozenset([
+        CustomCommands.EXPORT.value,  # Without arguments
+        CustomCommands.HISTORY.value,
+        CustomCommands.HASH.value,
+        CustomCommands.JOBS.value,
+        CustomCommands.STATS.value,
+    ])  # Builtins which only print, so their output may be piped or redirected
+
+
+    def _run_batch_command(self, callee: str, args: Optional[str]) -> Tuple[_Job, float, BinaryIO]:
+        '''
+        Run the command of a batch, collecting its output into a temporary file.
+        Return its job, elapsed time and the output file.
+        '''
+        out_file = tempfile.TemporaryFile()
+        start = perf_counter()
+
+        job, shell_argv = self._prepare_job(callee, args)
+        self._start_job(job, subprocess.DEVNULL, shell_argv, out_dst=out_file)
+        self._finish_job(job)
+
+        return job, perf_counter() - start, out_file
+
+
+    def _finish_batch_group(self, group: List[Future]) -> float:
+        '''
+        Wait for concurrent commands of a batch, print their outputs and log them in order.
+        Return the sum of their elapsed times.
+        '''
+        total_time = 0.0
+
+        for future in group:
+            job, elapsed, out_file = future.result()
+            total_time += elapsed
+
+            with out_file:
+                out_file.seek(0)
+                shutil.copyfileobj(out_file, self._stdout(), MyShell.RELAY_CHUNK_SIZE)
+            self._stdout().flush()
+
+            self._log_job(job)
+
+        return total_time
+
+
+    def run_batch(self, path: str, n_jobs: int = 1) -> None:
+        '''
+        Run commands from the file (`-` for stdin), up to `n_jobs` at once.
+
+        Note: stages of the file (separated by blank lines) run one after another,
+        commands inside a stage are independent and run concurrently, except of builtins which run alone.
+        Note: output of the commands is printed and logged in the order of the file, wall time is reported to stderr.
+        Note: commands have no input (builtins included), stdin may be the file itself.
+        Note: every command is added to the history, in the order of the file.
+        '''
+        with (nullcontext(sys.stdin) if path == '-' else open(path)) as batch_file:  # Stdin is not closed
+            commands = [line.strip() for line in batch_file]
+
+        start = perf_counter()
+        serial_time = 0.0
+        n_commands = 0
+        group = []
+        stdin = self._stdin
+        self._stdin = subprocess.DEVNULL
+
+        try:
+            with ThreadPoolExecutor(n_jobs) as pool:
+                for command in commands + ['']:
+                    if command.startswith('#'):
+                        continue
+
+                    callee, args = MyShell._separate_callee_and_args(command)
+
+                    if command and callee not in MyShell._BUILTINS:
+                        self._history.add(command)  # As builtins are by `_execute_command`
+                        group.append(pool.submit(self._run_batch_command, callee, args))
+                        n_commands += 1
+                        continue
+
+                    serial_time += self._finish_batch_group(group)
+                    group = []
+
+                    if command:
+                        command_start = perf_counter()
+                        self._execute_command(command)
+                        serial_time += perf_counter() - command_start
+                        n_commands += 1
+
+                        if self._exited:
+                            break
+        finally:
+            self._stdin = stdin
+
+        sys.stderr.write(
+            '{}: {} commands in {:.3f}s, {:.3f}s if run serially\n'
+                .format(MyShell.SHELL_NAME, n_commands, perf_counter() - start, serial_time)
+        )
+
+        if not self._exited:
+            self._execute_exit()
+        self._exited = False
+
+
+    def _install_readline(self) -> None:
+        '''
+        Integrate the history with readline, if the shell is interactive.
+
+        Note: input is not read by readline if stdin is not a TTY, so the history is not loaded then.
+        '''
+        if self._prompt and sys.stdin.isatty():
+            install_readline(self._history, MyShell.HISTORY_READLINE_PRELOAD)
+
+
+    def run(self) -> None:
+        '''
+        Run MyShell's main loop.
+
+        Note: loop breaks on `_exited` flag set.
+        Note: finished background jobs are reported before the prompt.
+        '''
+        self._install_readline()
+
+        while not self._exited:
+            try:
+                self._report_done_jobs()
+                self._execute_command(input(self._get_prompt()))
+
+            except (EOFError, KeyboardInterrupt):
+                self._execute_exit()
+                break
+
+        self._exited = False
+
+
+    def _read_line_async(prompt: str) -> asyncio.Future:
+        '''
+        Read a line from stdin (with readline, if available) in a separate thread, so the event loop is not blocked.
+
+        Note: the thread is a daemon, so a pending read does not keep the process alive.
+        '''
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def set_result(result: object, exc: Optional[BaseException]) -> None:
+            if not future.done():  # Might be cancelled meanwhile
+                if exc is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(exc)
+
+        def read() -> None:
+            try:
+                line = input(prompt)
+            except BaseException as e:
+                loop.call_soon_threadsafe(set_result, None, e)
+                return
+            loop.call_soon_threadsafe(set_result, line, None)
+
+        threading.Thread(target=read, name='myshell-input', daemon=True).start()
+        return future
+
+
+    async def run_async(self) -> None:
+        '''
+        Run MyShell's main loop on the running asyncio event loop.
+
+        Note: waiting for the input does not block the loop, so background jobs, logging
+        and other tasks of the loop progress meanwhile.
+        Note: loop breaks on `_exited` flag set, on end of input or on cancellation (`exit` is executed anyway).
+        '''
+        self._install_readline()
+
+        try:
+            while not self._exited:
+                self._report_done_jobs()
+                try:
+                    command = await MyShell._read_line_async(self._get_prompt())
+                except (EOFError, KeyboardInterrupt):
+                    break
+
+                await self.execute_async(command)
+        finally:
+            if not self._exited:
+                await self._execute_exit_async()
+            self._exited = False
+
+
+class _StreamOutput():
+    '''
+    Output of a shell to an asyncio stream, may be written from any thread.
+    '''
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        self._writer: asyncio.StreamWriter = writer
+        self._loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+        self._loop_thread: int = threading.get_ident()
+
+
+    def write(self, data: bytes) -> None:
+        if threading.get_ident() == self._loop_thread:
+            self._write(bytes(data))
+        else:  # E.g. by jobs relayed by threads
+            self._loop.call_soon_threadsafe(self._write, bytes(data))
+
+
+    def _write(self, data: bytes) -> None:
+        if not self._writer.is_closing():  # Output to a disconnected client is discarded
+            self._writer.write(data)
+
+
+    def flush(self) -> None:
+        pass
+
+
+    async def drain(self) -> None:
+        try:
+            await self._writer.drain()
+        except ConnectionError:
+            pass
+
+
+class MyShellServer():
+    '''
+    Server of MyShell sessions over a Unix socket, all of them run on one event loop.
+
+    Every connection gets its own session with its own CWD, history (in memory) and jobs.
+    Client sends commands line by line and gets their output followed by the prompt (printed also on connect);
+    the connection is closed after `exit` or on the end of client's input.
+    Note: log files are written by a single writer shared by the sessions.
+    Note: environment variables (`export`) are shared by the sessions, as they belong to the process.
+    '''
+    HISTORY_PATH: str = ':memory:'
+
+
+    def __init__(self, path: str, log_format: LogFormat = LogFormat.TEXT):
+        self._path: str = path
+        self._log_format: LogFormat = log_format
+        self._log_writer: _ActionLogWriter = _ActionLogWriter(
+            log_format,
+            MyShell.LOG_FLUSH_INTERVAL,
+            MyShell.LOG_FLUSH_SIZE,
+            MyShell.LOG_QUEUE_SIZE,
+        )
+
+
+    async def _serve_session(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        output = _StreamOutput(writer)
+        shell = MyShell(
+            log_format=self._log_format,
+            history_path=MyShellServer.HISTORY_PATH,
+            stdin=subprocess.DEVNULL,
+            output=output,
+            log_writer=self._log_writer,
+        )
+
+        try:
+            while not shell._exited:
+                shell._report_done_jobs()
+                output.write(shell._get_prompt().encode())
+                await output.drain()
+
+                line = await reader.readline()
+                if not line:
+                    break
+
+                await shell.execute_async(line.decode(errors='replace').rstrip('\n'))
+        except ConnectionError:  # Client is gone
+            pass
+        finally:
+            if not shell._exited:
+                await shell._execute_exit_async()
+            writer.close()
+
+
+    async def serve(self) -> None:
+        '''
+        Accept sessions until cancelled, then remove the socket.
+        '''
+        server = await asyncio.start_unix_server(self._serve_session, self._path)
+
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self._log_writer.close()
+            try:
+                os.unlink(self._path)
+            except FileNotFoundError:
+                pass
+
+
+def _parse_cli_args(args: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog=MyShell.SHELL_NAME)
+    parser.add_argument('--batch', metavar='FILE', help='run commands from the file (`-` for stdin) and exit')
+    parser.add_argument(
+        '--jobs',
+        metavar='N',
+        type=int,
+        default=os.cpu_count() or 1,
+        help='number of commands of a batch to run at once (default: number of CPUs)',
+    )
+    parser.add_argument('--no-prompt', action='store_true', help='do not print the prompt (e.g. for non-TTY stdin)')
+    parser.add_argument('--serve', metavar='SOCKET', help='serve sessions on the Unix socket by the path')
+    parser.add_argument(
+        '--async',
+        dest='use_async',
+        action='store_true',
+        help='run interactively on an asyncio event loop',
+    )
+    parser.add_argument(
+        '--log-format',
+        choices=[log_format.name.lower() for log_format in LogFormat],
+        default=LogFormat.TEXT.name.lower(),
+        help='format of the action log (default: text)',
+    )
+
+    return parser.parse_args(args)
+
+
+def main(args: List[str] = sys.argv[1:]) -> None:
+    params = _parse_cli_args(args)
+    log_format = LogFormat[params.log_format.upper()]
+
+    if params.serve is not None:
+        try:
+            asyncio.run(MyShellServer(params.serve, log_format).serve())
+        except KeyboardInterrupt:
+            pass
+        return
+
+    shell = MyShell(prompt=not params.no_prompt, log_format=log_format)
+
+    if params.batch is not None:
+        shell.run_batch(params.batch, params.jobs)
+    elif params.use_async:
+        try:
+            asyncio.run(shell.run_async())
+        except KeyboardInterrupt:  # Shell has already exited, the loop is interrupted
+            pass
+    else:
+        shell.run()
+
+
+if __name__ == '__main__':
+    main()
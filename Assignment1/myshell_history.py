@@ -0,0 +1,210 @@
+'''
+Author: Denis Chernikov, B16-SE-01, Innopolis University
+
+Persistent command history of MyShell with indexed search.
+'''
+
+import sqlite3
+import threading
+from time import monotonic, time
+from typing import List, Optional, Tuple
+
+
+GRAM_LENGTH: int = 3
+GRAM_COUNT_CAP: int = 1000
+
+_SCHEMA: str = '''
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    command TEXT NOT NULL,
+    time REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_command ON entries (command);
+CREATE TABLE IF NOT EXISTS grams (
+    gram TEXT NOT NULL,
+    entry_id INTEGER NOT NULL,
+    PRIMARY KEY (gram, entry_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS grams_entry ON grams (entry_id);
+'''
+
+
+def _grams(text: str) -> List[str]:
+    return list({text[i:i + GRAM_LENGTH] for i in range(len(text) - GRAM_LENGTH + 1)})
+
+
+class CommandHistory():
+    '''
+    History of commands stored in an SQLite database, bounded by `max_entries` (the oldest are evicted).
+
+    Commands are indexed by their value for prefix search and by their character trigrams for substring
+    search, so both do not scan the whole history.
+    Note: the database is opened on the first use only.
+    Note: added entries are committed at most once per `commit_interval` seconds and on closing.
+    '''
+
+    def __init__(self, path: str, max_entries: int, evict_batch: int = 100, commit_interval: float = 1.0):
+        self._path: str = path
+        self._max_entries: int = max_entries
+        self._evict_batch: int = evict_batch
+        self._commit_interval: float = commit_interval
+        self._last_commit: float = monotonic()
+        self._db: Optional[sqlite3.Connection] = None
+        self._lock: threading.Lock = threading.Lock()
+
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(self._path, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode = WAL')
+            self._db.execute('PRAGMA synchronous = NORMAL')
+            self._db.executescript(_SCHEMA)
+
+        return self._db
+
+
+    def close(self) -> None:
+        with self._lock:
+            if self._db is not None:
+                self._db.commit()
+                self._db.close()
+                self._db = None
+
+
+    def add(self, command: str) -> None:
+        with self._lock:
+            db = self._connect()
+
+            entry_id = db.execute(
+                'INSERT INTO entries (command, time) VALUES (?, ?)', (command, time()),
+            ).lastrowid
+            db.executemany(
+                'INSERT INTO grams (gram, entry_id) VALUES (?, ?)',
+                ((gram, entry_id) for gram in _grams(command)),
+            )
+
+            # Evicted in batches, so it is not done for every command
+            if entry_id % self._evict_batch == 0:
+                bound = entry_id - self._max_entries
+                db.execute('DELETE FROM grams WHERE entry_id <= ?', (bound,))
+                db.execute('DELETE FROM entries WHERE id <= ?', (bound,))
+
+            if monotonic() - self._last_commit >= self._commit_interval:
+                db.commit()
+                self._last_commit = monotonic()
+
+
+    def _query(self, sql: str, params: tuple) -> List[Tuple[int, str]]:
+        with self._lock:
+            return self._connect().execute(sql, params).fetchall()
+
+
+    def __len__(self) -> int:
+        return self._query('SELECT COUNT(*) FROM entries', ())[0][0]
+
+
+    def recent(self, n: Optional[int] = None) -> List[Tuple[int, str]]:
+        '''
+        Get the last `n` (or all) entries as (number, command), the oldest first.
+        '''
+        return self._query(
+            'SELECT * FROM (SELECT id, command FROM entries ORDER BY id DESC LIMIT ?) ORDER BY id',
+            (-1 if n is None else n,),
+        )
+
+
+    def search(self, text: str, limit: int = 10) -> List[Tuple[int, str]]:
+        '''
+        Get up to `limit` entries containing the text as (number, command), the latest first.
+        '''
+        grams = _grams(text)
+
+        if not grams:  # Too short to be indexed, the latest entries are checked until enough are found
+            return self._query(
+                'SELECT id, command FROM entries WHERE instr(command, ?) > 0 ORDER BY id DESC LIMIT ?',
+                (text, limit),
+            )
+
+        # Entries of the rarest trigram are checked, the latest first, until enough are found.
+        # Frequencies are counted up to a cap, so frequent trigrams do not cost more than rare ones.
+        counts = [
+            (self._query(
+                'SELECT COUNT(*) FROM (SELECT 1 FROM grams WHERE gram = ? LIMIT ?)', (gram, GRAM_COUNT_CAP),
+            )[0][0], gram)
+            for gram in grams
+        ]
+        count, rarest = min(counts)
+
+        if not count:
+            return []
+
+        return self._query(
+            '''
+            SELECT entries.id, entries.command FROM grams JOIN entries ON entries.id = grams.entry_id
+            WHERE grams.gram = ? AND instr(entries.command, ?) > 0
+            ORDER BY grams.entry_id DESC LIMIT ?
+            ''',
+            (rarest, text, limit),
+        )
+
+
+    def prefixed(self, prefix: str, limit: int = 10) -> List[str]:
+        '''
+        Get up to `limit` distinct commands starting with the prefix, the latest used first.
+        '''
+        # Range over the index: prefix <= command < prefix with the last character incremented
+        bounds = (prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)) if prefix else ('', chr(0x10FFFF))
+        count = self._query(
+            'SELECT COUNT(*) FROM (SELECT 1 FROM entries WHERE command >= ? AND command < ? LIMIT ?)',
+            (*bounds, GRAM_COUNT_CAP),
+        )[0][0]
+
+        if count < GRAM_COUNT_CAP:
+            return [command for _, command in self._query(
+                '''
+                SELECT MAX(id) AS last, command FROM entries WHERE command >= ? AND command < ?
+                GROUP BY command ORDER BY last DESC LIMIT ?
+                ''',
+                (*bounds, limit),
+            )]
+
+        # Frequent prefix: the latest entries are checked (`+` disables the index) until enough are found
+        res = []
+        with self._lock:
+            for command, in self._connect().execute(
+                'SELECT command FROM entries WHERE +command >= ? AND +command < ? ORDER BY id DESC', bounds,
+            ):
+                if command not in res:
+                    res.append(command)
+                    if len(res) == limit:
+                        break
+
+        return res
+
+
+def install_readline(history: CommandHistory, preload: int) -> None:
+    '''
+    Integrate the history with readline (if available): preload the last entries for arrow keys and Ctrl-R,
+    and complete the whole line with Tab by prefix search over the entire history.
+    '''
+    try:
+        import readline
+    except ImportError:
+        return
+
+    readline.clear_history()
+    for _, command in history.recent(preload):
+        readline.add_history(command)
+
+    matches = []
+
+    def complete(text: str, state: int) -> Optional[str]:
+        nonlocal matches
+        if state == 0:
+            matches = history.prefixed(readline.get_line_buffer())
+        return matches[state] if state < len(matches) else None
+
+    readline.set_completer_delims('')
+    readline.set_completer(complete)
+    readline.parse_and_bind('tab: complete')
+
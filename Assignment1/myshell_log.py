@@ -0,0 +1,482 @@
+'''
+Author: Denis Chernikov, B16-SE-01, Innopolis University
+
+Log formats of MyShell and `myshell-log`, the tool to query and convert them.
+
+Usage:
+    python myshell_log.py query BINARY_LOG [--since TIME] [--until TIME] [--cmd NAME]
+    python myshell_log.py convert TEXT_LOG BINARY_LOG
+'''
+
+import argparse
+from datetime import datetime, timedelta
+from enum import Enum
+import io
+import math
+import os
+import struct
+import sys
+from typing import BinaryIO, Iterator, List, NamedTuple, Optional, Tuple
+from zlib import crc32
+
+
+class ResourceUsage(NamedTuple):
+    '''
+    Resources used by a command's process (including its waited-for children).
+
+    Note: `max_rss` is a peak, so it is at least the memory of the shell forked before `exec` of the command.
+    '''
+    wall: float  # Seconds
+    user: float  # Seconds of CPU time
+    sys: float  # Seconds of CPU time
+    max_rss: int  # KiB, including the shell's memory before `exec`
+    read_bytes: int
+    written_bytes: int
+
+
+class LogEntry(NamedTuple):
+    '''
+    Single action logged by MyShell.
+
+    Note: `stdout` consists of byte strings and files positioned at the data (closed after writing).
+    Note: `stdout_size` is the full size of the output if only a part of it was captured.
+    Note: `usage` is known for subprocesses only.
+    '''
+    time: datetime
+    cmd: str
+    args: Optional[str]
+    pid: Optional[int]
+    exit_code: Optional[int]
+    stdout: List[object]
+    stdout_size: Optional[int] = None
+    usage: Optional[ResourceUsage] = None
+
+
+def _part_size(part: object) -> int:
+    if isinstance(part, bytes):
+        return len(part)
+
+    pos = part.tell()
+    end = part.seek(0, io.SEEK_END)
+    part.seek(pos)
+    return end - pos
+
+
+def entry_size(entry: LogEntry) -> int:
+    '''
+    Get the size of the entry's stdout parts in bytes.
+    '''
+    return sum(map(_part_size, entry.stdout))
+
+
+def _write_parts(dst: BinaryIO, parts: List[object], chunk_size: int = 64 * 1024) -> None:
+    for part in parts:
+        if isinstance(part, bytes):
+            dst.write(part)
+            continue
+
+        with part:
+            while True:
+                chunk = part.read(chunk_size)
+                if not chunk:
+                    break
+                dst.write(chunk)
+
+
+# ------------------------------ TEXT ------------------------------
+
+
+TEXT_ENTRY_SEP: bytes = b'\n=========================\n'
+_TEXT_FIELDS: List[str] = ['cmd', 'args', 'pid', 'exit']
+_TEXT_STDOUT_SIZE_PREFIX: str = '* stdout size: '
+_TEXT_USAGE_PREFIX: str = '* usage: '
+_TEXT_USAGE_FORMAT: str = 'wall={:.6f} user={:.6f} sys={:.6f} maxrss={} read={} written={}'
+
+
+def format_text_header(entry: LogEntry) -> bytes:
+    header = '[{}]\n* cmd: {}\n* args: {}\n* pid: {}\n* exit: {}\n'.format(
+        entry.time, entry.cmd, entry.args, entry.pid, entry.exit_code,
+    )
+
+    if entry.usage is not None:
+        header += _TEXT_USAGE_PREFIX + _TEXT_USAGE_FORMAT.format(*entry.usage) + '\n'
+    if entry.stdout_size is not None:
+        header += _TEXT_STDOUT_SIZE_PREFIX + '{}\n'.format(entry.stdout_size)
+
+    return (header + '* stdout:\n').encode()
+
+
+class TextLogFile():
+    '''
+    Human-readable log, can be searched only by a linear scan.
+    '''
+
+    def __init__(self, path: str):
+        self._file: BinaryIO = open(path, 'ab')
+
+
+    def append(self, entry: LogEntry) -> None:
+        self._file.write(format_text_header(entry))
+        _write_parts(self._file, entry.stdout)
+        self._file.write(TEXT_ENTRY_SEP)
+
+
+    def flush(self) -> None:
+        self._file.flush()
+
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def _parse_optional_int(text: str) -> Optional[int]:
+    return None if text == 'None' else int(text)
+
+
+def _is_text_entry(data: bytes) -> bool:
+    '''
+    Check if the data starts with a header of an entry (time and command), not with a part of a stdout.
+    '''
+    time_line, _, rest = data.partition(b'\n')
+    return time_line.startswith(b'[') and time_line.endswith(b']') and rest.startswith(b'* cmd: ')
+
+
+def _parse_text_entry(data: bytes) -> LogEntry:
+    header, stdout = data.split(b'\n* stdout:\n', 1)
+    header = header.decode()
+    time_line, rest = header.split('\n', 1)
+    fields = {}
+
+    # Values (e.g. args) may contain line breaks, so fields are split by their known names
+    for i, name in enumerate(_TEXT_FIELDS):
+        prefix = '* {}: '.format(name)
+        assert rest.startswith(prefix), 'field `{}` expected'.format(name)
+        rest = rest[len(prefix):]
+        next_prefix = '\n* {}: '.format(_TEXT_FIELDS[i + 1]) if i + 1 < len(_TEXT_FIELDS) else '\n'
+        if next_prefix in rest:
+            fields[name], rest = rest.split(next_prefix, 1)
+            rest = next_prefix[1:] + rest
+        else:
+            fields[name], rest = rest, ''
+
+    stdout_size = None
+    usage = None
+
+    for line in rest.splitlines():
+        if line.startswith(_TEXT_STDOUT_SIZE_PREFIX):
+            stdout_size = int(line[len(_TEXT_STDOUT_SIZE_PREFIX):])
+        elif line.startswith(_TEXT_USAGE_PREFIX):
+            values = [value.split('=', 1)[1] for value in line[len(_TEXT_USAGE_PREFIX):].split()]
+            usage = ResourceUsage(*map(float, values[:3]), *map(int, values[3:]))
+
+    return LogEntry(
+        datetime.fromisoformat(time_line.strip()[1:-1]),
+        fields['cmd'],
+        None if fields['args'] == 'None' else fields['args'],
+        _parse_optional_int(fields['pid']),
+        _parse_optional_int(fields['exit']),
+        [stdout],
+        stdout_size,
+        usage,
+    )
+
+
+def read_text_log(path: str, chunk_size: int = 1024 * 1024) -> Iterator[LogEntry]:
+    '''
+    Read entries of the text log one by one, without loading the whole file.
+
+    Note: an entry is yielded once the next one starts, since a separator not followed by a header
+    is a part of the stdout.
+    '''
+    with open(path, 'rb') as log_file:
+        buffer = bytearray()
+        entry = None  # Data of the entry not yielded yet
+
+        while True:
+            chunk = log_file.read(chunk_size)
+            # Only the new data (and a possibly split separator) has to be searched
+            search_from = max(0, len(buffer) - len(TEXT_ENTRY_SEP) + 1)
+            buffer += chunk
+            start = 0
+
+            while True:
+                end = buffer.find(TEXT_ENTRY_SEP, search_from)
+                if end < 0:
+                    break
+
+                data = bytes(buffer[start:end])
+                if entry is not None and not _is_text_entry(data):
+                    entry += TEXT_ENTRY_SEP + data
+                else:
+                    if entry is not None:
+                        yield _parse_text_entry(entry)
+                    entry = data
+                start = search_from = end + len(TEXT_ENTRY_SEP)
+
+            del buffer[:start]
+
+            if not chunk:
+                break
+
+        if entry is not None:
+            yield _parse_text_entry(entry)
+
+
+# ------------------------------ BINARY ------------------------------
+
+
+BINARY_INDEX_SUFFIX: str = '.idx'
+_RECORD_MAGIC_V1: bytes = b'MSL1'
+_RECORD_MAGIC_V2: bytes = b'MSL2'  # Resource usage follows the header
+_RECORD_MAGIC: bytes = b'MSL3'  # Length of cmd is 32-bit
+# magic, time, pid, exit, stdout size, lengths of: cmd, args, stdout
+_RECORD_HEADER: struct.Struct = struct.Struct('<4sdqqQIIQ')
+_RECORD_HEADER_V2: struct.Struct = struct.Struct('<4sdqqQHIQ')  # Of V1 and V2 records
+# wall (NaN if unknown), user, sys, max RSS, read, written
+_RECORD_USAGE: struct.Struct = struct.Struct('<dddqqq')
+_NO_USAGE: ResourceUsage = ResourceUsage(float('nan'), 0.0, 0.0, 0, 0, 0)
+# time, record offset, CRC32 of cmd
+_INDEX_ENTRY: struct.Struct = struct.Struct('<dQI')
+_INDEX_READ_ENTRIES: int = 4096
+_NONE_INT: int = -2 ** 63
+_NONE_SIZE: int = 2 ** 64 - 1
+_NO_ARGS: int = 2 ** 32 - 1
+_EPOCH: datetime = datetime(1970, 1, 1)
+
+
+def _to_timestamp(time: datetime) -> float:
+    return (time - _EPOCH).total_seconds()
+
+
+def _from_timestamp(timestamp: float) -> datetime:
+    return _EPOCH + timedelta(seconds=timestamp)
+
+
+def _cmd_hash(cmd: str) -> int:
+    return crc32(cmd.encode())
+
+
+class BinaryLogFile():
+    '''
+    Append-only log of length-prefixed records with an index file.
+
+    Index consists of fixed-size entries (time, record offset, command hash) in the order of records,
+    so it can be searched by time with a binary search and by command without touching the records.
+    '''
+
+    def __init__(self, path: str):
+        self._file: BinaryIO = open(path, 'ab')
+        self._index: BinaryIO = open(path + BINARY_INDEX_SUFFIX, 'ab')
+
+
+    def append(self, entry: LogEntry) -> None:
+        cmd = entry.cmd.encode()
+        args = b'' if entry.args is None else entry.args.encode()
+        timestamp = _to_timestamp(entry.time)
+        offset = self._file.tell()
+
+        self._file.write(
+            _RECORD_HEADER.pack(
+                _RECORD_MAGIC,
+                timestamp,
+                _NONE_INT if entry.pid is None else entry.pid,
+                _NONE_INT if entry.exit_code is None else entry.exit_code,
+                _NONE_SIZE if entry.stdout_size is None else entry.stdout_size,
+                len(cmd),
+                _NO_ARGS if entry.args is None else len(args),
+                entry_size(entry),
+            )
+        )
+        self._file.write(_RECORD_USAGE.pack(*(entry.usage or _NO_USAGE)))
+        self._file.write(cmd)
+        self._file.write(args)
+        _write_parts(self._file, entry.stdout)
+
+        self._index.write(_INDEX_ENTRY.pack(timestamp, offset, _cmd_hash(entry.cmd)))
+
+
+    def flush(self) -> None:
+        # Records first, so the index never points past the end of the log
+        self._file.flush()
+        self._index.flush()
+
+
+    def close(self) -> None:
+        self.flush()
+        self._file.close()
+        self._index.close()
+
+
+class BinaryLogReader():
+    '''
+    Reader of the binary log, seeking to the requested entries using the index.
+    '''
+
+    def __init__(self, path: str):
+        self._file: BinaryIO = open(path, 'rb')
+        self._index: BinaryIO = open(path + BINARY_INDEX_SUFFIX, 'rb')
+        self._n_entries: int = os.fstat(self._index.fileno()).st_size // _INDEX_ENTRY.size
+
+
+    def __enter__(self) -> 'BinaryLogReader':
+        return self
+
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+    def close(self) -> None:
+        self._file.close()
+        self._index.close()
+
+
+    def __len__(self) -> int:
+        return self._n_entries
+
+
+    def _index_entry(self, i: int) -> Tuple[float, int, int]:
+        self._index.seek(i * _INDEX_ENTRY.size)
+        return _INDEX_ENTRY.unpack(self._index.read(_INDEX_ENTRY.size))
+
+
+    def _index_entries(self, start: int, stop: int) -> Iterator[Tuple[float, int, int]]:
+        for chunk_start in range(start, stop, _INDEX_READ_ENTRIES):
+            n_entries = min(_INDEX_READ_ENTRIES, stop - chunk_start)
+            self._index.seek(chunk_start * _INDEX_ENTRY.size)
+            yield from _INDEX_ENTRY.iter_unpack(self._index.read(n_entries * _INDEX_ENTRY.size))
+
+
+    def _bisect(self, timestamp: float, right: bool = False) -> int:
+        '''
+        Find the position of the first index entry later than (if `right`) or not earlier than the time.
+        '''
+        low, high = 0, self._n_entries
+
+        while low < high:
+            middle = (low + high) // 2
+            middle_time = self._index_entry(middle)[0]
+
+            if middle_time < timestamp or right and middle_time == timestamp:
+                low = middle + 1
+            else:
+                high = middle
+
+        return low
+
+
+    def read_entry(self, offset: int) -> LogEntry:
+        self._file.seek(offset)
+        magic = self._file.read(len(_RECORD_MAGIC))
+        known_magics = (_RECORD_MAGIC, _RECORD_MAGIC_V2, _RECORD_MAGIC_V1)
+        assert magic in known_magics, 'corrupted log record at {}'.format(offset)
+
+        header = _RECORD_HEADER if magic == _RECORD_MAGIC else _RECORD_HEADER_V2
+        self._file.seek(offset)
+        _, timestamp, pid, exit_code, stdout_size, cmd_len, args_len, out_len = header.unpack(
+            self._file.read(header.size)
+        )
+
+        usage = None
+        if magic != _RECORD_MAGIC_V1:
+            usage = ResourceUsage(*_RECORD_USAGE.unpack(self._file.read(_RECORD_USAGE.size)))
+            if math.isnan(usage.wall):
+                usage = None
+
+        cmd = self._file.read(cmd_len).decode()
+        args = None if args_len == _NO_ARGS else self._file.read(args_len).decode()
+
+        return LogEntry(
+            _from_timestamp(timestamp),
+            cmd,
+            args,
+            None if pid == _NONE_INT else pid,
+            None if exit_code == _NONE_INT else exit_code,
+            [self._file.read(out_len)],
+            None if stdout_size == _NONE_SIZE else stdout_size,
+            usage,
+        )
+
+
+    def query(
+        self,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+        cmd: Optional[str] = None,
+    ) -> Iterator[LogEntry]:
+        '''
+        Get entries logged within the time range (inclusive) and, if given, with the command.
+        '''
+        start = 0 if since is None else self._bisect(_to_timestamp(since))
+        stop = self._n_entries if until is None else self._bisect(_to_timestamp(until), right=True)
+        cmd_hash = None if cmd is None else _cmd_hash(cmd)
+
+        offsets = [
+            offset for _, offset, entry_hash in self._index_entries(start, stop)
+            if cmd_hash is None or entry_hash == cmd_hash
+        ]
+
+        for offset in offsets:
+            entry = self.read_entry(offset)
+            if cmd is None or entry.cmd == cmd:  # Hashes may collide
+                yield entry
+
+
+# ------------------------------ CLI ------------------------------
+
+
+class LogFormat(Enum):
+    TEXT = TextLogFile
+    BINARY = BinaryLogFile
+
+
+def convert(text_log_path: str, binary_log_path: str) -> int:
+    '''
+    Append all the entries of the text log to the binary one, return the number of entries.
+    '''
+    binary_log = BinaryLogFile(binary_log_path)
+    n_entries = 0
+
+    try:
+        for entry in read_text_log(text_log_path):
+            binary_log.append(entry)
+            n_entries += 1
+    finally:
+        binary_log.close()
+
+    return n_entries
+
+
+def _parse_cli_args(args: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog='myshell-log', description='Query and convert MyShell logs.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    query_parser = commands.add_parser('query', help='print entries of a binary log')
+    query_parser.add_argument('log')
+    query_parser.add_argument('--since', type=datetime.fromisoformat, help='UTC time, ISO format')
+    query_parser.add_argument('--until', type=datetime.fromisoformat, help='UTC time, ISO format')
+    query_parser.add_argument('--cmd', help='command name')
+
+    convert_parser = commands.add_parser('convert', help='convert a text log into a binary one')
+    convert_parser.add_argument('text_log')
+    convert_parser.add_argument('binary_log')
+
+    return parser.parse_args(args)
+
+
+def main(args: List[str] = sys.argv[1:]) -> None:
+    params = _parse_cli_args(args)
+
+    if params.command == 'convert':
+        print('Converted {} entries'.format(convert(params.text_log, params.binary_log)))
+        return
+
+    with BinaryLogReader(params.log) as reader:
+        for entry in reader.query(params.since, params.until, params.cmd):
+            sys.stdout.buffer.write(format_text_header(entry))
+            _write_parts(sys.stdout.buffer, entry.stdout)
+            sys.stdout.buffer.write(TEXT_ENTRY_SEP)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,192 +1,1840 @@
-'''
-Author: Denis Chernikov, B16-SE-01, Innopolis University
-Python 3.7.2
-'''
-
-from enum import Enum, auto
-import os
-from timeit import timeit
-import sys
-
-
-def extend_with_spaces(to_extend, n):
-    return format(to_extend, '<' + str(n))
-
-
-class _BenchmarkParams(Enum):
-    HELP = auto()
-    FILES = auto()
-    FAILED = auto()
-
-
-class Benchmark:
-    PY_FILE_FORMATS = ['.py']
-    FAILED_WARNING = 'WARNING: This paths are either incorrect or impossible to read from:'
-    TABLE_HEADERS = ['PROGRAM', 'RANK', 'TIME ELAPSED']
-    TABLE_HEADER_SEP = ' | '
-    TABLE_N_DIGITS_AFTER_DOT = 9
-
-    MODULE_DESCRIPTION = '''
-This program ...
-'''  # TODO
-
-    def time(script_paths, verbose=False):
-        res = []
-
-        if not verbose:
-            stdout = sys.stdout
-            sys.stdout = open(os.devnull, 'w')
-
-        for path in script_paths:
-            with open(path) as script_file:
-                if verbose:
-                    print('Testing: {}'.format(path))
-
-                res.append(
-                    (
-                        path,
-                        timeit(script_file.read(), number=1),
-                    )
-                )
-
-        print()
-
-        if not verbose:
-            sys.stdout.close()
-            sys.stdout = stdout
-
-        return sorted(res, key=lambda t: t[1])
-
-
-    def table_result(res):
-        assert len(Benchmark.TABLE_HEADERS) > 2
-
-        n_res = len(res)
-        column_widths = []
-
-        column_widths.append(
-            max(
-                len(Benchmark.TABLE_HEADERS[0]),
-                max(map(lambda t: len(t[0]), res)),
-            )
-        )
-        column_widths.append(
-            max(
-                len(Benchmark.TABLE_HEADERS[1]),
-                len(str(n_res)),
-            )
-        )
-        max_int_time_str_len = len(str(int(max(map(lambda t: t[1], res)))))
-        max_num_len = max_int_time_str_len + Benchmark.TABLE_N_DIGITS_AFTER_DOT + 1
-        column_widths.append(
-            max(
-                len(Benchmark.TABLE_HEADERS[2]),
-                max_num_len + 1,  # because of trailing 's'
-            )
-        )
-
-        res_formated = []
-
-        for path, time in res:
-            res_formated.append(
-                (
-                    extend_with_spaces(path, column_widths[0]),
-                    ('{{:#{}.{}f}}s').format(
-                        max_num_len,
-                        Benchmark.TABLE_N_DIGITS_AFTER_DOT,
-                    ).format(time),
-                )
-            )
-
-        header = ''
-
-        for i in range(len(column_widths)):
-            if i > 0:
-                header += Benchmark.TABLE_HEADER_SEP
-
-            header += extend_with_spaces(Benchmark.TABLE_HEADERS[i], column_widths[i])
-
-        table_lines = [header]
-
-        for i in range(len(res)):
-            cur_res = res_formated[i]
-            table_lines.append(
-                extend_with_spaces('', len(Benchmark.TABLE_HEADER_SEP)).join(
-                    [
-                        extend_with_spaces(cur_res[0], column_widths[0]),
-                        extend_with_spaces(str(i + 1), column_widths[1]),
-                        extend_with_spaces(cur_res[1], column_widths[2]),
-                    ]
-                )
-            )
-
-        return os.linesep.join(table_lines)
-
-
-    def _print_failed_args(wrong_paths):
-        if not len(wrong_paths):
-            return
-
-        print(Benchmark.FAILED_WARNING)
-
-        for path in wrong_paths:
-            print(path)
-
-        print()
-
-
-    def _parse_args(args=sys.argv):
-        settings = {
-            _BenchmarkParams.HELP: False,
-            _BenchmarkParams.FILES: None,
-            _BenchmarkParams.FAILED: None,
-        }
-
-        if args is None or len(args) <= 1:
-            settings[_BenchmarkParams.HELP] = True
-        else:
-            failed = []
-
-            def is_available_py_file(path):
-                res = any(
-                    path.endswith(format) for format in Benchmark.PY_FILE_FORMATS
-                ) and os.access(path, os.R_OK)
-
-                if not res:
-                    failed.append(path)
-
-                return res
-
-            settings[_BenchmarkParams.FILES] = list(
-                filter(
-                    is_available_py_file,
-                    map(lambda arg: arg.strip(), args[1:]),
-                )
-            )
-            settings[_BenchmarkParams.FAILED] = failed
-
-        return settings
-
-
-    def _print_help():
-        print('usage: {} [files]'.format(sys.argv[0]))
-        print(Benchmark.MODULE_DESCRIPTION)
-
-
-    def _exec():
-        params = Benchmark._parse_args()
-
-        if params[_BenchmarkParams.HELP]:
-            Benchmark._print_help()
-            return
-
-        Benchmark._print_failed_args(params[_BenchmarkParams.FAILED])
-        print(
-            Benchmark.table_result(
-                Benchmark.time(params[_BenchmarkParams.FILES])
-            )
-        )
-
-
-if __name__ == "__main__":
-    Benchmark._exec()
+'''
+Author: Denis Chernikov, B16-SE-01, Innopolis University
+Python 3.7.2
+'''
+
+import bisect
+from collections import Counter, namedtuple
+from concurrent.futures import as_completed, ThreadPoolExecutor
+import cProfile
+import csv
+from datetime import datetime
+from enum import Enum, auto
+import gc
+import glob
+import hashlib
+import itertools
+import json
+import marshal
+import math
+import os
+import pstats
+import resource
+import select
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+from time import perf_counter_ns, process_time_ns
+import traceback
+import tracemalloc
+
+
+def extend_with_spaces(to_extend, n):
+    return format(to_extend, '<' + str(n))
+
+
+def extend_with_spaces_left(to_extend, n):
+    return format(to_extend, '>' + str(n))
+
+
+# Summary of repeated measurements, `ci` is the half-width of 95% confidence interval of the mean
+RunStats = namedtuple('RunStats', ['n', 'min', 'median', 'p95', 'mean', 'stdev', 'ci'])
+
+# Result of benchmarking of a single script: its content hash, raw measurements of every run, summaries
+# of times (seconds) of execution, compilation and imports during the execution, summary of peak RSS (KiB),
+# number of outlier runs which were retried, whether the script
+# is significantly better than the next one by the ranking metric, allocations traced in a separate run,
+# workload parameters the script was run with and its profile aggregated over separate profiled runs.
+# A failed script has the `error` with the tail of its `output` instead of measurements.
+# `cached` tells if the result was loaded from the results cache instead of being measured
+ScriptResult = namedtuple(
+    'ScriptResult',
+    [
+        'path', 'hash', 'runs', 'wall', 'cpu', 'compile', 'imports', 'max_rss', 'retried', 'significant',
+        'alloc', 'params', 'profile', 'error', 'output', 'cached',
+    ],
+    defaults=[0, None, None, None, None, None, None, False],
+)
+
+
+class _RunFailed(Exception):
+    '''
+    A run of the script failed: its error and the tail of its output are the arguments.
+    '''
+
+
+class _ImportTimer():
+    '''
+    Finder of modules (to be the first in `sys.meta_path`) timing their loads (outermost ones only,
+    nested ones are their part): finding them by the other finders and executing them by their loaders.
+
+    Note: imports of modules loaded already do not reach finders, so they are not slowed down.
+    Note: execution of modules by loaders which are classes (of builtin and frozen modules) is not timed.
+    '''
+
+    def __init__(self):
+        self.time_ns = 0
+        self._depth = 0
+
+
+    def find_spec(self, name, path=None, target=None):
+        start = perf_counter_ns() if not self._depth else None
+        try:
+            spec = next(
+                (
+                    spec for spec in (
+                        finder.find_spec(name, path, target) for finder in sys.meta_path
+                        if finder is not self and hasattr(finder, 'find_spec')
+                    )
+                    if spec is not None
+                ),
+                None,
+            )
+        finally:
+            if start is not None:
+                self.time_ns += perf_counter_ns() - start
+
+        loader = None if spec is None else spec.loader
+        if isinstance(getattr(loader, '__dict__', None), dict) and 'exec_module' not in vars(loader):
+            loader.exec_module = self._timed(loader.exec_module)
+
+        return spec
+
+
+    def _timed(self, exec_module):
+        def timed_exec_module(module):
+            if self._depth:
+                return exec_module(module)
+
+            self._depth += 1
+            start = perf_counter_ns()
+            try:
+                return exec_module(module)
+            finally:
+                self.time_ns += perf_counter_ns() - start
+                self._depth -= 1
+
+        return timed_exec_module
+
+
+class _BenchmarkParams(Enum):
+    HELP = auto()
+    FILES = auto()
+    FAILED = auto()
+    ERROR = auto()
+    RUNS = auto()
+    WARMUP = auto()
+    PARALLEL = auto()
+    ISOLATE = auto()
+    NO_GC = auto()
+    RETRIES = auto()
+    TRACEMALLOC = auto()
+    RANK_BY = auto()
+    JSON = auto()
+    CSV = auto()
+    STORE = auto()
+    BASELINE = auto()
+    THRESHOLD = auto()
+    PARAMS = auto()
+    PARAMS_IN_ARGV = auto()
+    PROFILE = auto()
+    PROFILE_TOP = auto()
+    COLLAPSED = auto()
+    TIMEOUT = auto()
+    MEMORY_LIMIT = auto()
+    FRESH = auto()
+    CODE_CACHE = auto()
+    CACHE = auto()
+    FORCE = auto()
+    CACHE_MAX_AGE = auto()
+    CACHE_MAX_SIZE = auto()
+    WORKER = auto()
+
+
+class Benchmark:
+    PY_FILE_FORMATS = ['.py']
+    GLOB_CHARS = '*?['
+    SKIPPED_DIR_PREFIXES = ['.', '__pycache__']
+    FAILED_WARNING = 'WARNING: This paths are either incorrect or impossible to read from:'
+    TABLE_HEADERS = ['PROGRAM', 'RANK']
+    TABLE_HEADER_SEP = ' | '
+    TABLE_N_DIGITS_AFTER_DOT = 9
+    DEFAULT_RUNS = 5
+    DEFAULT_WARMUP = 1
+    DEFAULT_PARALLEL = 1
+    DEFAULT_RETRIES = 2
+    WORKER_ARG = '--worker'
+    NS_IN_S = 10 ** 9
+    US_IN_S = 10 ** 6
+    NS_IN_US = 10 ** 3
+    KIB_IN_MIB = 1024
+    BYTES_IN_MIB = 1024 ** 2
+    DEFAULT_TIMEOUT = 60.0  # Seconds
+    OUTPUT_TAIL_SIZE = 4096  # Bytes of a run's output kept
+    FAILURE_OUTPUT_LINES = 5  # Lines of a failed run's output shown
+    CODE_CACHE_SUFFIX = '.code'
+    CACHE_VERSION = 1
+    CACHE_SUFFIX = '.json'
+    DEFAULT_CACHE_MAX_AGE = 30.0  # Days
+    DEFAULT_CACHE_MAX_SIZE = 100  # MiB
+    SECONDS_IN_DAY = 24 * 60 * 60
+    TOP_ALLOCATIONS = 5
+    DEFAULT_RANK_BY = 'wall'
+    DEFAULT_THRESHOLD = 10.0  # Percent
+    STORE_VERSION = 1
+    CSV_HEADERS = ['path', 'hash', 'params', 'run', 'wall_ns', 'cpu_ns', 'compile_ns', 'import_ns', 'max_rss_kib']
+    BASELINE_HEADERS = ['PROGRAM', 'BASELINE', 'CURRENT', 'CHANGE', 'STATUS']
+    HASH_CHUNK_SIZE = 64 * 1024
+    RANGE_SEP = '..'
+    RANGE_STEPS_SEP = ':'
+    RANGE_DEFAULT_FACTOR = 10
+    DEFAULT_PROFILE_TOP = 10
+    PROFILE_SEND_LIMIT = 200  # Functions with the most cumulative time a worker reports
+    SAMPLING_INTERVAL = 0.001  # Seconds of CPU time
+    PROFILE_HEADERS = ['FUNCTION', 'CUMULATIVE', 'SELF', 'CALLS']
+    # Complexity models to fit timings to: t = c * f(n)
+    COMPLEXITIES = [
+        ('O(1)', lambda n: 1.0),
+        ('O(log n)', lambda n: math.log(max(n, 2))),
+        ('O(n)', lambda n: n),
+        ('O(n log n)', lambda n: n * math.log(max(n, 2))),
+        ('O(n^2)', lambda n: n ** 2),
+        ('O(n^3)', lambda n: n ** 3),
+    ]
+    MIN_FIT_SIZES = 3  # With fewer sizes any model fits
+    OUTLIER_MADS = 3.0  # Runs slower than the median by more than this number of (scaled) MADs are outliers
+    MAD_SCALE = 1.4826  # Makes MAD consistent with the standard deviation of normal distribution
+    P95 = 0.95
+    # Two-sided 95% quantiles of Student's t-distribution by degrees of freedom (1..30), normal one after
+    T_95 = [
+        12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+        2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+        2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042,
+    ]
+    Z_95 = 1.960
+
+    MODULE_DESCRIPTION = '''
+This program ranks Python scripts by their execution time.
+
+Directories are searched for scripts recursively (skipping hidden and `__pycache__` ones),
+glob patterns are expanded (`**` matches any number of directories, quote the patterns
+so the shell does not expand them). Every script is reported to stderr as soon as
+it is benchmarked, with its rank among the ones benchmarked so far.
+
+Every script is run several times (after warmup runs, which are not measured), each time
+in a fresh process forked from a worker interpreter, so scripts do not affect each other
+and the interpreter is started once per worker. Scripts are ranked by the median time.
+A script which fails, exceeds the timeout or the memory limit is reported as failed.
+
+options:
+  --runs N      number of measured runs of every script (default: {runs})
+  --warmup N    number of unmeasured runs of every script before measured ones (default: {warmup})
+  --parallel N  number of scripts to benchmark at once, each pinned to its own CPU (default: {parallel})
+  --isolate     pin every script to a single CPU also when benchmarking one at a time
+  --no-gc       disable garbage collection during the measured part of the runs
+  --retries N   number of times to rerun outlier runs, i.e. much slower than the others (default: {retries})
+  --tracemalloc trace allocations of every script in an extra (unmeasured, slower) run,
+                show its peak traced memory and the top allocation sites
+  --rank-by M   metric to rank by: {metrics} (default: {rank_by}); `alloc` implies --tracemalloc
+  --json FILE   write all the results, including every run, to the file as JSON
+  --csv FILE    write every run to the file as CSV
+  --store FILE  save the results to the store (JSON), keyed by script path and content hash
+  --baseline FILE
+                compare median wall times with the latest ones saved to the store for the same paths,
+                exit with code 1 if any script is slower beyond the threshold (and significantly,
+                unless either side has a single run)
+  --threshold P allowed slowdown against the baseline, percent (default: {threshold})
+  --param NAME=VALUES
+                run every script for every value of the workload parameter (may be repeated for a grid),
+                VALUES are comma-separated numbers and ranges: `A..B` (A, 10A, 100A, ... up to B)
+                or `A..B:K` (K points from A to B evenly spaced on log scale), e.g. `N=1e3..1e7`
+  --param-argv  pass the parameters to the scripts as `--NAME VALUE` arguments instead of global variables
+  --profile P   profile every script in extra (unmeasured) runs, as many as measured ones, and show its
+                hot functions by mean cumulative time: P is `cprofile` (deterministic, exact numbers of calls)
+                or `sampling` (samples the stack every {interval}ms of CPU time, lower overhead)
+  --profile-top N
+                number of hot functions to show for every script (default: {profile_top})
+  --collapsed FILE
+                write sampled stacks of all the scripts to the file in collapsed format for flame graphs,
+                implies `--profile sampling`
+  --timeout S   wall-clock time limit of every run, seconds (default: {timeout})
+  --memory-limit MB
+                address space limit of every run (including the interpreter), MiB
+  --fresh       start a fresh worker for every run instead of reusing workers (slower)
+  --code-cache DIR
+                cache compiled scripts in the directory, keyed by their path and content hash
+  --cache DIR   reuse the results cached in the directory for the scripts with the same content, measured
+                by the same interpreter with the same parameters and options (runs, warmup, retries, GC,
+                tracing, profiling), measure and cache only the others
+  --force       measure all the scripts again, even if their results are cached
+  --cache-max-age DAYS
+                remove the cached results not used for longer (default: {cache_max_age})
+  --cache-max-size MB
+                remove the least recently used cached results beyond this total size (default: {cache_max_size})
+
+With parameters, scripts are ranked for every point of the grid, then their median times are
+shown by the first parameter which varies, with the best fitting empirical complexity
+(if there are at least {min_fit_sizes} values of it).
+
+Wall and CPU times of the execution of scripts are reported separately, compilation is not included
+in them: its time (or loading time of the cached code) is reported as COMPILE. IMPORTS is the part
+of the wall time spent in imports (outermost ones, by `import` statements and `__import__`).
+Modules imported by the worker itself (standard ones it uses) are already loaded for the scripts.
+Peak RSS of the process (including the interpreter) is reported too. SIGNIFICANT tells if the script
+is better than the next one in the ranking with 95% confidence (Welch's t-test).
+
+Only the content of the scripts themselves is hashed for the results cache, not of the modules they import.
+Cached results were measured in other sessions, possibly under a different load of the machine.
+'''
+
+    OPTIONS = {
+        '--runs': (_BenchmarkParams.RUNS, DEFAULT_RUNS, 1),
+        '--warmup': (_BenchmarkParams.WARMUP, DEFAULT_WARMUP, 0),
+        '--parallel': (_BenchmarkParams.PARALLEL, DEFAULT_PARALLEL, 1),
+        '--retries': (_BenchmarkParams.RETRIES, DEFAULT_RETRIES, 0),
+        '--isolate': (_BenchmarkParams.ISOLATE, False, None),
+        '--no-gc': (_BenchmarkParams.NO_GC, False, None),
+        '--tracemalloc': (_BenchmarkParams.TRACEMALLOC, False, None),
+        '--rank-by': (_BenchmarkParams.RANK_BY, DEFAULT_RANK_BY, ['wall', 'cpu', 'rss', 'alloc']),
+        '--json': (_BenchmarkParams.JSON, None, str),
+        '--csv': (_BenchmarkParams.CSV, None, str),
+        '--store': (_BenchmarkParams.STORE, None, str),
+        '--baseline': (_BenchmarkParams.BASELINE, None, str),
+        '--threshold': (_BenchmarkParams.THRESHOLD, DEFAULT_THRESHOLD, 0.0),
+        '--param': (_BenchmarkParams.PARAMS, None, list),
+        '--param-argv': (_BenchmarkParams.PARAMS_IN_ARGV, False, None),
+        '--profile': (_BenchmarkParams.PROFILE, None, ['cprofile', 'sampling']),
+        '--profile-top': (_BenchmarkParams.PROFILE_TOP, DEFAULT_PROFILE_TOP, 1),
+        '--collapsed': (_BenchmarkParams.COLLAPSED, None, str),
+        '--timeout': (_BenchmarkParams.TIMEOUT, DEFAULT_TIMEOUT, 0.01),
+        '--memory-limit': (_BenchmarkParams.MEMORY_LIMIT, None, 1),
+        '--fresh': (_BenchmarkParams.FRESH, False, None),
+        '--code-cache': (_BenchmarkParams.CODE_CACHE, None, str),
+        '--cache': (_BenchmarkParams.CACHE, None, str),
+        '--force': (_BenchmarkParams.FORCE, False, None),
+        '--cache-max-age': (_BenchmarkParams.CACHE_MAX_AGE, DEFAULT_CACHE_MAX_AGE, 0.0),
+        '--cache-max-size': (_BenchmarkParams.CACHE_MAX_SIZE, DEFAULT_CACHE_MAX_SIZE, 0),
+    }  # Option -> (parameter, default value, minimal number or allowed values or `str` or `list` (repeated)
+    # or `None` for flags)
+
+    RANK_METRICS = {
+        'wall': lambda res: res.wall,
+        'cpu': lambda res: res.cpu,
+        'rss': lambda res: res.max_rss,
+        'alloc': None,  # Traced once, so there are no statistics
+    }  # Metric -> statistics of the metric
+
+    TABLE_COLUMNS = [
+        ('MIN', lambda res: Benchmark._format_time(res.wall.min)),
+        ('MEDIAN', lambda res: Benchmark._format_time(res.wall.median)),
+        ('P95', lambda res: Benchmark._format_time(res.wall.p95)),
+        ('STDDEV', lambda res: Benchmark._format_time(res.wall.stdev)),
+        ('95% CI', lambda res: Benchmark._format_time(res.wall.ci)),
+        ('CPU MEDIAN', lambda res: Benchmark._format_time(res.cpu.median)),
+        ('COMPILE', lambda res: Benchmark._format_time(res.compile.median)),
+        ('IMPORTS', lambda res: Benchmark._format_time(res.imports.median)),
+        ('PEAK RSS', lambda res: Benchmark._format_size(res.max_rss.median)),
+        ('RETRIED', lambda res: str(res.retried)),
+        ('SIGNIFICANT', lambda res: '-' if res.significant is None else 'yes' if res.significant else 'no'),
+    ]  # Header -> value to show
+    ALLOC_COLUMNS = [
+        ('ALLOC PEAK', lambda res: Benchmark._format_size(res.alloc['peak'] / Benchmark.KIB_IN_MIB)),
+    ]
+
+    def _serve_worker():
+        '''
+        Serve as a worker: read configs of runs from stdin (JSON, one per line), make every run
+        in a forked child (see `_fork_run`) and write its outcome to stdout (JSON, one per line).
+        Meant to be run as `compare.py --worker`, so the interpreter is started once for many runs.
+        '''
+        for line in sys.stdin:
+            outcome = Benchmark._fork_run(json.loads(line))
+            sys.stdout.write(json.dumps(outcome) + '\n')
+            sys.stdout.flush()
+
+
+    def _fork_run(config):
+        '''
+        Run the script once in a forked child with the config (see `_run_worker`) limited by its `timeout`
+        (seconds, the child's process group is killed then) and `memory_limit` (MiB of address space),
+        return the outcome: the measurements (`result`, with peak RSS of the child, KiB) or the `error`,
+        and the tail of the child's stdout and stderr (`output`).
+        '''
+        result_read, result_write = os.pipe()
+        output = tempfile.TemporaryFile()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+
+        if pid == 0:  # Child
+            os.setpgid(0, 0)
+            os.close(result_read)
+            exit_code = 1
+
+            try:
+                with open(os.devnull) as devnull:
+                    os.dup2(devnull.fileno(), sys.stdin.fileno())
+                sys.stdin = open(os.devnull)  # The worker's one may have configs read ahead
+                os.dup2(output.fileno(), sys.stdout.fileno())
+                os.dup2(output.fileno(), sys.stderr.fileno())
+
+                if config.get('memory_limit') is not None:
+                    limit = config['memory_limit'] * Benchmark.BYTES_IN_MIB
+                    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+                Benchmark._run_worker(config, os.fdopen(result_write, 'w'))
+                exit_code = 0
+            except SystemExit as e:
+                print('SystemExit: {}'.format(e.code), file=sys.stderr)
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(exit_code)
+
+        os.close(result_write)
+        try:
+            os.setpgid(pid, pid)  # Whichever of the two is the first
+        except OSError:
+            pass
+
+        with os.fdopen(result_read) as result_file:
+            timed_out = not select.select([result_file], [], [], config.get('timeout'))[0]
+            if timed_out:
+                os.killpg(pid, signal.SIGKILL)
+            result = result_file.read()
+
+        _, status, rusage = os.wait4(pid, 0)  # Unlike `waitpid`, gives resource usage
+
+        with output:
+            output.seek(max(0, output.seek(0, os.SEEK_END) - Benchmark.OUTPUT_TAIL_SIZE))
+            output_tail = output.read().decode(errors='replace')
+
+        if timed_out:
+            error = 'timed out after {}s'.format(config['timeout'])
+        elif os.WIFSIGNALED(status):
+            error = 'killed by {}'.format(signal.Signals(os.WTERMSIG(status)).name)
+        elif os.WEXITSTATUS(status):
+            lines = output_tail.strip().splitlines()
+            error = lines[-1] if lines else 'exited with code {}'.format(os.WEXITSTATUS(status))
+        else:
+            error = None
+
+        if error is None:
+            try:
+                result = dict(json.loads(result), max_rss=rusage.ru_maxrss)
+            except ValueError:  # E.g. the script ended by `os._exit`
+                error = 'exited without reporting results'
+
+        return {
+            'result': result if error is None else None,
+            'error': error,
+            'output': output_tail,
+        }
+
+
+    def _run_worker(config, result_file):
+        '''
+        Run the script once in this process and write the measurements (in nanoseconds) to the file as JSON.
+        Meant to be run in a forked child of a worker (see `_fork_run`). The config is a JSON object
+        with the script's `path`, the `cpu` to run on (if any), whether to keep `gc` enabled,
+        whether to `tracemalloc` (then peak traced memory and top allocation sites are written too),
+        workload `params`, whether to pass them as arguments (`params_in_argv`) instead of globals,
+        the profiler to `profile` with (then the script's functions and sampled stacks are written too)
+        and the directory to cache the compiled script in (`code_cache`).
+
+        Note: compilation is measured separately from the execution, as well as imports during the execution
+        (except for traced and profiled runs, whose times are not used).
+        '''
+        path = config['path']
+
+        if config.get('cpu') is not None and hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, {config['cpu']})
+
+        start_compile = perf_counter_ns()
+        code = Benchmark._load_code(path, config.get('code_cache'))
+        compile_time = perf_counter_ns() - start_compile
+
+        params = config.get('params') or {}
+        sys.path[0] = os.path.dirname(os.path.abspath(path))
+        namespace = {'__name__': '__main__', '__file__': path}
+
+        if config.get('params_in_argv'):
+            sys.argv = [path] + [arg for name, value in params.items() for arg in ['--' + name, str(value)]]
+        else:
+            sys.argv = [path]
+            namespace.update(params)
+
+        if not config.get('gc', True):
+            gc.collect()  # Garbage of the startup is not collected during the measurement
+            gc.disable()
+
+        if config.get('tracemalloc'):
+            tracemalloc.start()
+
+        import_time = 0
+        start_cpu = process_time_ns()
+        start_wall = perf_counter_ns()
+
+        if config.get('profile') == 'cprofile':
+            profile = Benchmark._exec_cprofiled(code, namespace)
+        elif config.get('profile') == 'sampling':
+            profile = Benchmark._exec_sampled(code, namespace)
+        elif config.get('tracemalloc'):
+            Benchmark._exec_script(code, namespace)
+        else:
+            import_time = Benchmark._exec_timing_imports(code, namespace)
+
+        wall = perf_counter_ns() - start_wall
+        cpu = process_time_ns() - start_cpu
+
+        gc.enable()
+        sys.stdout.flush()
+        result = {'wall_ns': wall, 'cpu_ns': cpu, 'compile_ns': compile_time, 'import_ns': import_time}
+
+        if config.get('profile'):
+            result['profile'] = profile
+
+        if tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, __file__),
+                tracemalloc.Filter(False, tracemalloc.__file__),
+            ])
+            result['alloc'] = {
+                'peak': tracemalloc.get_traced_memory()[1],
+                'top': [
+                    {'site': str(stat.traceback), 'size': stat.size, 'count': stat.count}
+                    for stat in snapshot.statistics('lineno')[:Benchmark.TOP_ALLOCATIONS]
+                ],
+            }
+            tracemalloc.stop()
+
+        json.dump(result, result_file)
+        result_file.close()
+
+
+    def _exec_script(code, namespace):
+        '''
+        Execute the code of the script, exiting with `sys.exit()` or `sys.exit(0)` is its normal end.
+        '''
+        try:
+            exec(code, namespace)
+        except SystemExit as e:
+            if e.code not in (None, 0):
+                raise
+
+
+    def _load_code(path, cache_dir=None):
+        '''
+        Compile the script, or load its code from the cache directory (if given), where it is cached
+        by its path and content hash for this version of the interpreter.
+        '''
+        with open(path, 'rb') as script_file:
+            source = script_file.read()
+
+        if cache_dir is None:
+            return compile(source, path, 'exec')
+
+        key = hashlib.sha256(os.path.abspath(path).encode() + b'\0' + source).hexdigest()
+        cache_path = os.path.join(
+            cache_dir,
+            '{}.{}{}'.format(key, sys.implementation.cache_tag, Benchmark.CODE_CACHE_SUFFIX),
+        )
+
+        try:
+            with open(cache_path, 'rb') as cache_file:
+                return marshal.load(cache_file)
+        except (OSError, EOFError, ValueError, TypeError):  # Not cached yet or corrupted
+            pass
+
+        code = compile(source, path, 'exec')
+        os.makedirs(cache_dir, exist_ok=True)
+        Benchmark._write_atomically(cache_path, lambda out: marshal.dump(code, out), binary=True)
+        return code
+
+
+    def _exec_timing_imports(code, namespace):
+        '''
+        Execute the code, return time spent in loading modules by its imports (see `_ImportTimer`).
+        '''
+        timer = _ImportTimer()
+        sys.meta_path.insert(0, timer)
+        try:
+            Benchmark._exec_script(code, namespace)
+        finally:
+            sys.meta_path.remove(timer)
+
+        return timer.time_ns
+
+
+    def _exec_cprofiled(code, namespace):
+        '''
+        Execute the code under cProfile, return its functions with the most cumulative time.
+        '''
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            Benchmark._exec_script(code, namespace)
+        finally:
+            profiler.disable()
+
+        functions = [
+            {
+                'function': name if path == '~' else '{}:{}({})'.format(path, line, name),
+                'calls': n_calls,
+                'self': self_time,
+                'cumulative': cumulative_time,
+            }
+            for (path, line, name), (_, n_calls, self_time, cumulative_time, callers)
+            in pstats.Stats(profiler).stats.items()
+            # Called by the worker only: `exec` of the script and `disable` of the profiler
+            if any(caller[0] != __file__ for caller in callers)
+        ]
+
+        return {
+            'functions': sorted(functions, key=lambda f: -f['cumulative'])[:Benchmark.PROFILE_SEND_LIMIT],
+            'stacks': {},
+        }
+
+
+    def _exec_sampled(code, namespace):
+        '''
+        Execute the code sampling its stack on every `SAMPLING_INTERVAL` of CPU time (with `SIGPROF`),
+        return its functions with the most cumulative time and the sampled stacks in collapsed format.
+
+        Note: every stack is weighted by CPU time since the previous sample (in microseconds), since signals
+        arriving during a long call of C code are handled once it returns, as a single one.
+        '''
+        stacks = Counter()
+        last_sample_ns = [process_time_ns()]
+
+        def sample(signum, frame):
+            sample_ns = process_time_ns()
+            weight = (sample_ns - last_sample_ns[0]) // Benchmark.NS_IN_US
+            last_sample_ns[0] = sample_ns
+            stack = []
+            while frame is not None:
+                if frame.f_code.co_filename != __file__:  # The worker's frames are not the script's
+                    stack.append('{}:{}'.format(frame.f_code.co_filename, frame.f_code.co_name))
+                frame = frame.f_back
+            if stack:
+                stacks[';'.join(reversed(stack))] += weight
+
+        old_handler = signal.signal(signal.SIGPROF, sample)
+        signal.setitimer(signal.ITIMER_PROF, Benchmark.SAMPLING_INTERVAL, Benchmark.SAMPLING_INTERVAL)
+        try:
+            Benchmark._exec_script(code, namespace)
+        finally:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, old_handler)
+
+        self_us = Counter()
+        cumulative_us = Counter()
+
+        for stack, weight in stacks.items():
+            frames = stack.split(';')
+            self_us[frames[-1]] += weight
+            for function in set(frames):  # Recursive calls are counted once
+                cumulative_us[function] += weight
+
+        functions = [
+            {
+                'function': function,
+                'calls': None,
+                'self': self_us[function] / Benchmark.US_IN_S,
+                'cumulative': weight / Benchmark.US_IN_S,
+            }
+            for function, weight in cumulative_us.most_common(Benchmark.PROFILE_SEND_LIMIT)
+        ]
+
+        return {'functions': functions, 'stacks': dict(stacks)}
+
+
+    def _aggregate_profiles(profiles):
+        '''
+        Aggregate profiles of several runs: mean times and numbers of calls of functions, total sampled stacks.
+        '''
+        functions = {}
+        stacks = Counter()
+
+        for profile in profiles:
+            stacks.update(profile['stacks'])
+
+            for f in profile['functions']:
+                total = functions.setdefault(
+                    f['function'],
+                    {'function': f['function'], 'calls': None, 'self': 0.0, 'cumulative': 0.0},
+                )
+                total['self'] += f['self'] / len(profiles)
+                total['cumulative'] += f['cumulative'] / len(profiles)
+                if f['calls'] is not None:
+                    total['calls'] = (total['calls'] or 0) + f['calls'] / len(profiles)
+
+        return {
+            'runs': len(profiles),
+            'functions': sorted(functions.values(), key=lambda f: -f['cumulative']),
+            'stacks': dict(stacks),
+        }
+
+
+    def _start_worker(verbose=False):
+        return subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), Benchmark.WORKER_ARG],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=None if verbose else subprocess.DEVNULL,
+            universal_newlines=True,
+        )
+
+
+    def _stop_worker(worker):
+        try:
+            worker.stdin.close()
+        except BrokenPipeError:  # The worker is dead already
+            pass
+        worker.wait()
+        worker.stdout.close()
+
+
+    def _replace_dead_worker(worker, verbose=False):
+        '''
+        Get a new worker in place of the given one if it is dead, otherwise the given one.
+        '''
+        if worker is None or worker.poll() is None:
+            return worker
+
+        Benchmark._stop_worker(worker)
+        return Benchmark._start_worker(verbose)
+
+
+    def _run_once(config, worker=None, verbose=False):
+        '''
+        Make a run of the script by the worker (a fresh one, if not given) with the config, return its measurements
+        along with peak RSS of the process (`max_rss`, KiB), raise `_RunFailed` if it failed.
+
+        Note: if the worker dies, the run fails, the worker is to be replaced then (see `_replace_dead_worker`).
+        '''
+        if worker is None:
+            worker = Benchmark._start_worker(verbose)
+            try:
+                return Benchmark._run_once(config, worker, verbose)
+            finally:
+                Benchmark._stop_worker(worker)
+
+        try:
+            worker.stdin.write(json.dumps(config) + '\n')
+            worker.stdin.flush()
+            outcome = worker.stdout.readline()
+        except BrokenPipeError:
+            outcome = ''
+
+        if not outcome:
+            raise _RunFailed('worker exited with code {}'.format(worker.wait()), '')
+
+        outcome = json.loads(outcome)
+        if outcome['error'] is not None:
+            raise _RunFailed(outcome['error'], outcome['output'])
+
+        return outcome['result']
+
+
+    def _t_95(df):
+        return Benchmark.T_95[df - 1] if df <= len(Benchmark.T_95) else Benchmark.Z_95
+
+
+    def _summarize(values, scale=1):
+        times = sorted(value / scale for value in values)
+        n = len(times)
+        stdev = statistics.stdev(times) if n > 1 else 0.0
+
+        return RunStats(
+            n=n,
+            min=times[0],
+            median=statistics.median(times),
+            p95=times[math.ceil(Benchmark.P95 * n) - 1],  # Nearest rank
+            mean=statistics.mean(times),
+            stdev=stdev,
+            ci=Benchmark._t_95(n - 1) * stdev / math.sqrt(n) if n > 1 else 0.0,
+        )
+
+
+    def _find_outliers(times):
+        '''
+        Get indices of the times exceeding the median by more than `OUTLIER_MADS` scaled median absolute deviations.
+
+        Note: only slow runs are outliers, since noise (interrupts, other processes) only slows runs down.
+        '''
+        median = statistics.median(times)
+        mad = Benchmark.MAD_SCALE * statistics.median(abs(time - median) for time in times)
+
+        return [i for i, time in enumerate(times) if time - median > Benchmark.OUTLIER_MADS * mad and mad > 0]
+
+
+    def _is_faster(a, b):
+        '''
+        Check if the mean of the first times is less than the second one's with 95% confidence (Welch's t-test).
+        '''
+        if a.n < 2 or b.n < 2:
+            return False
+
+        var_a, var_b = a.stdev ** 2 / a.n, b.stdev ** 2 / b.n
+        if not var_a + var_b:
+            return a.mean < b.mean
+
+        t = (b.mean - a.mean) / math.sqrt(var_a + var_b)
+        df = (var_a + var_b) ** 2 / (var_a ** 2 / (a.n - 1) + var_b ** 2 / (b.n - 1))
+
+        return t > Benchmark._t_95(max(1, int(df)))  # Rounding down is conservative
+
+
+    def _benchmark_script(
+        path,
+        runs,
+        warmup,
+        cpu=None,
+        verbose=False,
+        use_gc=True,
+        retries=DEFAULT_RETRIES,
+        trace_alloc=False,
+        params=None,
+        params_in_argv=False,
+        profile=None,
+        worker=None,
+        timeout=DEFAULT_TIMEOUT,
+        memory_limit=None,
+        code_cache=None,
+    ):
+        '''
+        Benchmark the script by the worker (fresh ones for every run, if not given), rerunning the outlier runs
+        up to `retries` times. If any run fails, the result has the error instead of measurements.
+        '''
+        if verbose:
+            print('Testing: {}{}'.format(path, ' ' + Benchmark._format_params(params) if params else ''))
+
+        config = {
+            'path': path,
+            'cpu': cpu,
+            'gc': use_gc,
+            'params': params,
+            'params_in_argv': params_in_argv,
+            'timeout': timeout,
+            'memory_limit': memory_limit,
+            'code_cache': code_cache,
+        }
+        content_hash = Benchmark._hash_file(path)
+
+        def run_once(run_config):
+            return Benchmark._run_once(run_config, worker, verbose)
+
+        try:
+            for _ in range(warmup):
+                run_once(config)
+
+            measured = [run_once(config) for _ in range(runs)]
+            retried = 0
+
+            for _ in range(retries):
+                outliers = Benchmark._find_outliers([run['wall_ns'] for run in measured])
+                if not outliers:
+                    break
+
+                retried += len(outliers)
+                for i in outliers:
+                    measured[i] = run_once(config)
+
+            return ScriptResult(
+                path=path,
+                hash=content_hash,
+                runs=measured,
+                wall=Benchmark._summarize([run['wall_ns'] for run in measured], Benchmark.NS_IN_S),
+                cpu=Benchmark._summarize([run['cpu_ns'] for run in measured], Benchmark.NS_IN_S),
+                compile=Benchmark._summarize([run['compile_ns'] for run in measured], Benchmark.NS_IN_S),
+                imports=Benchmark._summarize([run['import_ns'] for run in measured], Benchmark.NS_IN_S),
+                max_rss=Benchmark._summarize([run['max_rss'] for run in measured]),
+                retried=retried,
+                alloc=run_once(dict(config, tracemalloc=True))['alloc'] if trace_alloc else None,
+                params=params,
+                profile=Benchmark._aggregate_profiles([
+                    run_once(dict(config, profile=profile))['profile'] for _ in range(runs)
+                ]) if profile else None,
+            )
+        except _RunFailed as e:
+            error, output = e.args
+            if verbose:
+                print('Failed: {}: {}'.format(path, error))
+
+            return ScriptResult(
+                path=path,
+                hash=content_hash,
+                runs=[],
+                wall=None,
+                cpu=None,
+                compile=None,
+                imports=None,
+                max_rss=None,
+                params=params,
+                error=error,
+                output=output,
+            )
+
+
+    def _hash_file(path):
+        content_hash = hashlib.sha256()
+
+        with open(path, 'rb') as script_file:
+            for chunk in iter(lambda: script_file.read(Benchmark.HASH_CHUNK_SIZE), b''):
+                content_hash.update(chunk)
+
+        return content_hash.hexdigest()
+
+
+    def _cache_key(content_hash, params, options):
+        '''
+        Make the key of a script's result in the results cache by its content hash, the interpreter version,
+        workload parameters and the options of the measurement the result depends on.
+        '''
+        return hashlib.sha256(
+            json.dumps([content_hash, sys.version, params or {}, options], sort_keys=True).encode()
+        ).hexdigest()
+
+
+    def _load_cached(cache_dir, key):
+        path = os.path.join(cache_dir, key + Benchmark.CACHE_SUFFIX)
+
+        try:
+            with open(path) as cache_file:
+                entry = json.load(cache_file)
+        except (OSError, ValueError):  # Not cached or corrupted
+            return None
+
+        if entry.get('version') != Benchmark.CACHE_VERSION:
+            return None
+
+        os.utime(path)  # Used recently, so it is evicted last
+        return Benchmark._result_from_dict(entry['result'])
+
+
+    def _save_cached(cache_dir, key, r):
+        os.makedirs(cache_dir, exist_ok=True)
+        Benchmark._write_atomically(
+            os.path.join(cache_dir, key + Benchmark.CACHE_SUFFIX),
+            lambda out: json.dump({'version': Benchmark.CACHE_VERSION, 'result': Benchmark._result_to_dict(r)}, out),
+        )
+
+
+    def evict_cache(cache_dir, max_age=DEFAULT_CACHE_MAX_AGE, max_size=DEFAULT_CACHE_MAX_SIZE):
+        '''
+        Remove the results not used for more than `max_age` days from the cache directory, then the least
+        recently used ones until the total size of the cache is at most `max_size` MiB.
+        Return the number of removed results.
+        '''
+        if not os.path.isdir(cache_dir):
+            return 0
+
+        entries = []  # (last use, size, path)
+        for name in os.listdir(cache_dir):
+            if name.endswith(Benchmark.CACHE_SUFFIX):
+                stat = os.stat(os.path.join(cache_dir, name))
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(cache_dir, name)))
+
+        entries.sort(reverse=True)  # The most recently used first
+        oldest_kept = datetime.now().timestamp() - max_age * Benchmark.SECONDS_IN_DAY
+        total_size = 0
+        n_removed = 0
+
+        for last_use, size, path in entries:
+            total_size += size
+            if last_use < oldest_kept or total_size > max_size * Benchmark.BYTES_IN_MIB:
+                os.unlink(path)
+                n_removed += 1
+
+        return n_removed
+
+
+    def _get_cpus():
+        if hasattr(os, 'sched_getaffinity'):
+            return sorted(os.sched_getaffinity(0))
+        return list(range(os.cpu_count() or 1))
+
+
+    def time(
+        script_paths,
+        verbose=False,
+        runs=DEFAULT_RUNS,
+        warmup=DEFAULT_WARMUP,
+        parallel=DEFAULT_PARALLEL,
+        isolate=False,
+        use_gc=True,
+        retries=DEFAULT_RETRIES,
+        trace_alloc=False,
+        rank_by=DEFAULT_RANK_BY,
+        params=None,
+        params_in_argv=False,
+        profile=None,
+        timeout=DEFAULT_TIMEOUT,
+        memory_limit=None,
+        fresh=False,
+        code_cache=None,
+        cache=None,
+        force=False,
+        on_result=None,
+    ):
+        '''
+        Benchmark the scripts, return their results sorted by the median of the ranking metric
+        (see `RANK_METRICS`), the failed ones last.
+
+        Note: `params` (if given) are passed to every script as global variables or as arguments.
+        Note: with `profile` (`cprofile` or `sampling`), every script is also profiled in separate runs.
+        Note: every run is limited by `timeout` (seconds) and `memory_limit` (MiB of address space, if given).
+        Note: with `code_cache` (a directory), compiled scripts are cached there.
+        Note: with `cache` (a directory), results of the scripts are reused from there (unless `force`)
+        and saved there, see `_cache_key`.
+        Note: `on_result(result, rank, n_done)` (if given) is called as soon as every script is benchmarked,
+        with its rank among the `n_done` scripts benchmarked so far.
+
+        Note: runs are forked from workers (one per script benchmarked at once) started for the call,
+        with `fresh`, a fresh interpreter is started for every run instead.
+
+        Note: with `parallel` > 1, scripts are benchmarked concurrently, the ones running at once
+        are pinned to different CPUs (if there are enough of them).
+        Note: with `isolate`, scripts benchmarked one at a time are pinned to the last CPU,
+        which is usually the least busy with interrupts.
+        '''
+        cpus = Benchmark._get_cpus()
+
+        if parallel <= 1:
+            free_cpus = [cpus[-1] if isolate else None]
+        else:
+            free_cpus = cpus[:parallel] if parallel <= len(cpus) else [None] * parallel
+
+        workers = [None if fresh else Benchmark._start_worker(verbose) for _ in free_cpus]
+        free_slots = list(zip(free_cpus, workers))
+
+        trace_alloc = trace_alloc or rank_by == 'alloc'
+        cached_options = {
+            'runs': runs,
+            'warmup': warmup,
+            'retries': retries,
+            'gc': use_gc,
+            'tracemalloc': trace_alloc,
+            'profile': profile,
+            'params_in_argv': params_in_argv,
+        }
+
+        def benchmark(path):
+            key = None if cache is None else Benchmark._cache_key(Benchmark._hash_file(path), params, cached_options)
+
+            if key is not None and not force:
+                cached = Benchmark._load_cached(cache, key)
+                if cached is not None:
+                    if verbose:
+                        print('Cached: {}'.format(path))
+                    return cached._replace(path=path, cached=True)
+
+            cpu, worker = free_slots.pop()
+            try:
+                r = Benchmark._benchmark_script(
+                    path,
+                    runs,
+                    warmup,
+                    cpu,
+                    verbose,
+                    use_gc,
+                    retries,
+                    trace_alloc,
+                    params,
+                    params_in_argv,
+                    profile,
+                    worker,
+                    timeout,
+                    memory_limit,
+                    code_cache,
+                )
+            finally:
+                new_worker = Benchmark._replace_dead_worker(worker, verbose)
+                if new_worker is not worker:
+                    workers[workers.index(worker)] = new_worker
+                free_slots.append((cpu, new_worker))
+
+            if key is not None and r.error is None:
+                Benchmark._save_cached(cache, key, r)
+
+            return r
+
+        get_stats = Benchmark.RANK_METRICS[rank_by]
+
+        def rank_key(r):
+            if r.error is not None:
+                return (True, 0)
+            return (False, r.alloc['peak'] if get_stats is None else get_stats(r).median)
+
+        res = []
+        res_keys = []  # Ranking keys of `res`, which is kept sorted
+
+        try:
+            with ThreadPoolExecutor(parallel) as pool:
+                for future in as_completed([pool.submit(benchmark, path) for path in script_paths]):
+                    r = future.result()
+                    key = rank_key(r)
+                    rank = bisect.bisect(res_keys, key)
+                    res_keys.insert(rank, key)
+                    res.insert(rank, r)
+
+                    if on_result is not None:
+                        on_result(r, rank + 1, len(res))
+        finally:
+            for worker in workers:
+                if worker is not None:
+                    Benchmark._stop_worker(worker)
+
+        if verbose:
+            print()
+
+        return [
+            r._replace(
+                significant=(
+                    Benchmark._is_faster(get_stats(r), get_stats(res[i + 1]))
+                    if get_stats is not None and i + 1 < len(res) and res[i + 1].error is None else None
+                )
+            ) if r.error is None else r
+            for i, r in enumerate(res)
+        ]
+
+
+    def _parse_number(text):
+        number = float(text)
+        return int(number) if number.is_integer() else number
+
+
+    def _parse_param(spec):
+        '''
+        Parse the parameter specification `NAME=VALUES` (see `MODULE_DESCRIPTION`) into the name and its values.
+        '''
+        name, sep, values_spec = spec.partition('=')
+        if not sep or not name.isidentifier():
+            raise ValueError('parameter must be NAME=VALUES, got {!r}'.format(spec))
+
+        values = []
+
+        for part in values_spec.split(','):
+            if Benchmark.RANGE_SEP not in part:
+                values.append(Benchmark._parse_number(part))
+                continue
+
+            bounds, _, steps = part.partition(Benchmark.RANGE_STEPS_SEP)
+            first, last = map(float, bounds.split(Benchmark.RANGE_SEP, 1))
+            if not 0 < first <= last:
+                raise ValueError('range must be 0 < A <= B, got {!r}'.format(part))
+
+            if steps:
+                steps = int(steps)
+                if steps < 1:
+                    raise ValueError('number of range points must be positive, got {!r}'.format(part))
+                factor = (last / first) ** (1 / (steps - 1)) if steps > 1 else 1
+                points = [first * factor ** i for i in range(steps)]
+            else:
+                points = [first]
+                while points[-1] * Benchmark.RANGE_DEFAULT_FACTOR <= last * (1 + 1e-9):
+                    points.append(points[-1] * Benchmark.RANGE_DEFAULT_FACTOR)
+
+            values += [Benchmark._parse_number(round(point)) if point >= 1 else point for point in points]
+
+        return name, values
+
+
+    def make_grid(param_specs):
+        '''
+        Make the grid of parameters (a list of dicts, all combinations of the values) by their specifications.
+        '''
+        params = [Benchmark._parse_param(spec) for spec in param_specs or []]
+
+        return [
+            dict(zip([name for name, _ in params], values))
+            for values in itertools.product(*[values for _, values in params])
+        ]
+
+
+    def _format_params(params):
+        return ' '.join('{}={}'.format(name, value) for name, value in (params or {}).items())
+
+
+    def _fit_complexity(sizes, times):
+        '''
+        Fit the times to every model of `COMPLEXITIES` by least squares, return the best one's name
+        and its RMS error relative to the mean time.
+        '''
+        mean = statistics.mean(times)
+        best = None
+
+        for name, f in Benchmark.COMPLEXITIES:
+            values = [f(size) for size in sizes]
+            c = sum(t * v for t, v in zip(times, values)) / sum(v * v for v in values)
+            rms = math.sqrt(sum((t - c * v) ** 2 for t, v in zip(times, values)) / len(times))
+
+            if best is None or rms < best[1]:
+                best = (name, rms)
+
+        return best[0], best[1] / mean if mean else 0.0
+
+
+    def scaling_result(res):
+        '''
+        Make a table of median times of the scripts by the first parameter which varies (a row for every
+        combination of the other ones) with the best fitting empirical complexity.
+
+        Note: the complexity is not fitted (`-`) for rows with fewer than `MIN_FIT_SIZES` sizes.
+        '''
+        done = [r for r in res if r.error is None]
+        names = list(done[0].params) if done else []
+        size_name = next((name for name in names if len({r.params[name] for r in done}) > 1), None)
+        if size_name is None and names:
+            size_name = names[0]
+
+        rows = {}  # (path, other parameters) -> {size -> result}
+        sizes = []
+
+        for r in done:
+            size = r.params[size_name]
+            others = Benchmark._format_params({name: value for name, value in r.params.items() if name != size_name})
+            rows.setdefault((r.path, others), {})[size] = r
+            if size not in sizes:
+                sizes.append(size)
+
+        sizes.sort()
+        headers = ['PROGRAM'] + ['{}={}'.format(size_name, size) for size in sizes] + ['FIT', 'RMS']
+        table_rows = []
+
+        for (path, others), by_size in rows.items():
+            fit = ['-', '-']
+            if len(by_size) >= Benchmark.MIN_FIT_SIZES:
+                row_sizes = sorted(by_size)
+                complexity, error = Benchmark._fit_complexity(
+                    row_sizes,
+                    [by_size[size].wall.median for size in row_sizes],
+                )
+                fit = [complexity, '{:.1f}%'.format(error * 100)]
+
+            table_rows.append(
+                ['{} {}'.format(path, others).strip()]
+                + [Benchmark._format_time(by_size[size].wall.median) if size in by_size else '-' for size in sizes]
+                + fit
+            )
+
+        return Benchmark._format_table(headers, table_rows, 1)
+
+
+    def _format_time(time):
+        return '{{:.{}f}}s'.format(Benchmark.TABLE_N_DIGITS_AFTER_DOT).format(time)
+
+
+    def _format_size(kib):
+        return '{:.1f} MiB'.format(kib / Benchmark.KIB_IN_MIB)
+
+
+    def profile_result(res, top=DEFAULT_PROFILE_TOP):
+        '''
+        Make tables of the top hot functions (by mean cumulative time) of every profiled script.
+        '''
+        lines = []
+
+        for r in res:
+            if r.profile is None:
+                continue
+
+            lines.append('Hot functions of {} (mean of {} profiled runs):'.format(
+                ' '.join([r.path, Benchmark._format_params(r.params)]).strip(),
+                r.profile['runs'],
+            ))
+            lines.append(
+                Benchmark._format_table(
+                    Benchmark.PROFILE_HEADERS,
+                    [
+                        [
+                            f['function'],
+                            Benchmark._format_time(f['cumulative']),
+                            Benchmark._format_time(f['self']),
+                            '-' if f['calls'] is None else '{:g}'.format(f['calls']),
+                        ]
+                        for f in r.profile['functions'][:top]
+                    ],
+                    1,
+                )
+            )
+            lines.append('')
+
+        return os.linesep.join(lines)
+
+
+    def write_collapsed(res, path):
+        '''
+        Write sampled stacks of the profiled scripts to the file in collapsed format (`frame;frame weight`),
+        every stack is rooted at its script (and parameters), weights are microseconds of CPU time.
+        '''
+        def write(out):
+            for r in res:
+                if r.profile is None:
+                    continue
+
+                root = ' '.join([r.path, Benchmark._format_params(r.params)]).strip()
+                for stack, weight in sorted(r.profile['stacks'].items()):
+                    out.write('{};{} {}\n'.format(root, stack, weight))
+
+        Benchmark._write_atomically(path, write)
+
+
+    def alloc_result(res):
+        '''
+        Make a list of the top allocation sites of every script with traced allocations.
+
+        Note: sites are ranked by memory they hold at the end of the script.
+        '''
+        lines = []
+
+        for r in res:
+            if r.alloc is None:
+                continue
+
+            lines.append('Top allocations of {}:'.format(r.path))
+            lines += [
+                '  {:>12.1f} KiB  {:>8} blocks  {}'.format(
+                    site['size'] / Benchmark.KIB_IN_MIB,
+                    site['count'],
+                    site['site'],
+                )
+                for site in r.alloc['top']
+            ]
+
+        return os.linesep.join(lines)
+
+
+    def table_result(res, columns=None):
+        '''
+        Make a table of the results (in the given order) with the given columns (header, value getter),
+        `TABLE_COLUMNS` by default.
+        '''
+        columns = Benchmark.TABLE_COLUMNS if columns is None else columns
+        headers = Benchmark.TABLE_HEADERS + [header for header, _ in columns]
+
+        rows = [
+            [r.path, str(i + 1)] + [get_value(r) for _, get_value in columns] if r.error is None
+            else [r.path, '-'] + ['-'] * len(columns)
+            for i, r in enumerate(res)
+        ]
+
+        return Benchmark._format_table(headers, rows, len(Benchmark.TABLE_HEADERS))
+
+
+    def failure_result(res):
+        '''
+        Make a list of the failed scripts with their errors and the last lines of their output.
+        '''
+        lines = []
+
+        for r in res:
+            if r.error is None:
+                continue
+
+            name = ' '.join([r.path, Benchmark._format_params(r.params)]).strip()
+            lines.append('FAILED: {}: {}'.format(name, r.error))
+            lines += ['  ' + line for line in (r.output or '').rstrip().splitlines()[-Benchmark.FAILURE_OUTPUT_LINES:]]
+
+        return os.linesep.join(lines)
+
+
+    def _format_table(headers, rows, n_left_aligned):
+        '''
+        Format the table, values of the first `n_left_aligned` columns are aligned to the left,
+        the others (numbers) are aligned to the right.
+        '''
+        column_widths = [
+            max([len(headers[i])] + [len(row[i]) for row in rows])
+            for i in range(len(headers))
+        ]
+
+        header = Benchmark.TABLE_HEADER_SEP.join(
+            extend_with_spaces(headers[i], column_widths[i]) for i in range(len(headers))
+        )
+
+        table_lines = [header]
+
+        for row in rows:
+            table_lines.append(
+                Benchmark.TABLE_HEADER_SEP.join(
+                    [extend_with_spaces(row[i], column_widths[i]) for i in range(n_left_aligned)]
+                    + [
+                        extend_with_spaces_left(row[i], column_widths[i])
+                        for i in range(n_left_aligned, len(headers))
+                    ]
+                )
+            )
+
+        return os.linesep.join(table_lines)
+
+
+    def _result_from_dict(d):
+        stats = {
+            name: RunStats(**d[name])
+            for name in ['wall', 'cpu', 'compile', 'imports', 'max_rss']
+            if d.get(name) is not None
+        }
+        return ScriptResult(**dict(d, **stats))
+
+
+    def _result_to_dict(r):
+        return dict(
+            r._asdict(),
+            wall=r.wall and r.wall._asdict(),
+            cpu=r.cpu and r.cpu._asdict(),
+            compile=r.compile and r.compile._asdict(),
+            imports=r.imports and r.imports._asdict(),
+            max_rss=r.max_rss and r.max_rss._asdict(),
+        )
+
+
+    def _write_atomically(path, write, binary=False):
+        '''
+        Write the file with `write(file)` into a temporary file next to it, then replace the file,
+        so it is never left half-written.
+        '''
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+
+        try:
+            with (os.fdopen(fd, 'wb') if binary else os.fdopen(fd, 'w', newline='')) as tmp_file:
+                write(tmp_file)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+    def write_json(res, path):
+        '''
+        Write the results (in the given order), including every run, to the file as JSON.
+        '''
+        Benchmark._write_atomically(
+            path,
+            lambda out: json.dump([Benchmark._result_to_dict(r) for r in res], out, indent=2),
+        )
+
+
+    def write_csv(res, path):
+        '''
+        Write every run of the results to the file as CSV.
+        '''
+        def write(out):
+            writer = csv.writer(out)
+            writer.writerow(Benchmark.CSV_HEADERS)
+            for r in res:
+                for i, run in enumerate(r.runs):
+                    writer.writerow([
+                        r.path,
+                        r.hash,
+                        Benchmark._format_params(r.params),
+                        i + 1,
+                        run['wall_ns'],
+                        run['cpu_ns'],
+                        run['compile_ns'],
+                        run['import_ns'],
+                        run['max_rss'],
+                    ])
+
+        Benchmark._write_atomically(path, write)
+
+
+    def _load_store(path):
+        if not os.path.exists(path):
+            return {'version': Benchmark.STORE_VERSION, 'scripts': {}}
+
+        with open(path) as store_file:
+            store = json.load(store_file)
+
+        if store.get('version') != Benchmark.STORE_VERSION:
+            raise ValueError('{}: unsupported results store version {}'.format(path, store.get('version')))
+
+        return store
+
+
+    def update_store(res, path):
+        '''
+        Save the results to the store by the path, keyed by script path and content hash with parameters
+        (results of the same script content and parameters are replaced). Failed scripts are not saved.
+        '''
+        store = Benchmark._load_store(path)
+        saved_at = datetime.now().isoformat()
+
+        for r in res:
+            if r.error is not None:
+                continue
+
+            entry = dict(Benchmark._result_to_dict(r), saved_at=saved_at, python=sys.version)
+            key = ' '.join([r.hash, Benchmark._format_params(r.params)]).strip()
+            store['scripts'].setdefault(os.path.normpath(r.path), {})[key] = entry
+
+        Benchmark._write_atomically(path, lambda out: json.dump(store, out, indent=2))
+
+
+    def compare_with_baseline(res, path, threshold=DEFAULT_THRESHOLD):
+        '''
+        Compare median wall times of the results with the latest ones saved to the store by the path
+        for the same scripts and parameters (whatever the scripts' content was). Return a table of the comparison
+        and the number of regressions: scripts slower by more than `threshold` percent and significantly
+        (failed scripts are shown, but not counted).
+
+        Note: significance cannot be tested with a single run on either side, then the threshold alone decides.
+        '''
+        scripts = Benchmark._load_store(path)['scripts']
+        rows = []
+        n_regressions = 0
+
+        def is_faster(a, b):
+            return Benchmark._is_faster(a, b) if a.n > 1 and b.n > 1 else a.median < b.median
+
+        for r in res:
+            name = ' '.join([r.path, Benchmark._format_params(r.params)]).strip()
+            entries = [
+                entry for entry in scripts.get(os.path.normpath(r.path), {}).values()
+                if (entry.get('params') or {}) == (r.params or {})
+            ]
+
+            base = RunStats(**max(entries, key=lambda entry: entry['saved_at'])['wall']) if entries else None
+
+            if r.error is not None:
+                rows.append([name, '-' if base is None else Benchmark._format_time(base.median), '-', '-', 'FAILED'])
+                continue
+
+            if base is None:
+                rows.append([name, '-', Benchmark._format_time(r.wall.median), '-', 'new'])
+                continue
+
+            change = (r.wall.median / base.median - 1) * 100 if base.median else 0.0
+
+            if change > threshold and is_faster(base, r.wall):
+                status = 'REGRESSION'
+                n_regressions += 1
+            elif change < -threshold and is_faster(r.wall, base):
+                status = 'improved'
+            else:
+                status = 'ok'
+
+            rows.append([
+                name,
+                Benchmark._format_time(base.median),
+                Benchmark._format_time(r.wall.median),
+                '{:+.1f}%'.format(change),
+                status,
+            ])
+
+        return Benchmark._format_table(Benchmark.BASELINE_HEADERS, rows, 1), n_regressions
+
+
+    def progress_result(r, rank, n_done, n_total):
+        '''
+        Make a progress line about the script's result with its rank among the results so far.
+        '''
+        name = ' '.join([r.path, Benchmark._format_params(r.params)]).strip()
+        counter = '[{}/{}]'.format(extend_with_spaces_left(n_done, len(str(n_total))), n_total)
+
+        if r.error is not None:
+            return '{} {}: FAILED: {}'.format(counter, name, r.error)
+
+        return '{} {}: median {}, rank {} of {} so far{}'.format(
+            counter,
+            name,
+            Benchmark._format_time(r.wall.median),
+            rank,
+            n_done,
+            ' (cached)' if r.cached else '',
+        )
+
+
+    def _find_scripts(arg, failed):
+        '''
+        Find the scripts by the argument: a path to a script, a directory to search recursively
+        or a glob pattern. Paths which are not readable scripts and patterns matching nothing are added to `failed`.
+        '''
+        def is_py_file(path):
+            return any(path.endswith(format) for format in Benchmark.PY_FILE_FORMATS)
+
+        if os.path.isdir(arg):
+            paths = []
+            for dir_path, dir_names, file_names in os.walk(arg):
+                dir_names[:] = sorted(
+                    name for name in dir_names
+                    if not any(name.startswith(prefix) for prefix in Benchmark.SKIPPED_DIR_PREFIXES)
+                )
+                paths += [os.path.join(dir_path, name) for name in sorted(file_names) if is_py_file(name)]
+        elif any(char in arg for char in Benchmark.GLOB_CHARS):
+            paths = [path for path in sorted(glob.glob(arg, recursive=True)) if is_py_file(path)]
+            if not paths:
+                failed.append(arg)
+        else:
+            paths = [arg]
+
+        res = []
+        for path in paths:
+            if is_py_file(path) and os.path.isfile(path) and os.access(path, os.R_OK):
+                res.append(path)
+            else:
+                failed.append(path)
+
+        return res
+
+
+    def _print_failed_args(wrong_paths):
+        if not len(wrong_paths):
+            return
+
+        print(Benchmark.FAILED_WARNING)
+
+        for path in wrong_paths:
+            print(path)
+
+        print()
+
+
+    def _parse_options(args, settings):
+        '''
+        Take the options (`--name value` or `--name=value`) out of the arguments into the settings,
+        return the rest of the arguments.
+        '''
+        rest = []
+        args = iter(args)
+
+        for arg in args:
+            name, sep, value = arg.partition('=')
+
+            if name not in Benchmark.OPTIONS:
+                rest.append(arg)
+                continue
+
+            param, _, allowed = Benchmark.OPTIONS[name]
+            if allowed is None:  # Flag
+                settings[param] = True
+                continue
+            if not sep:
+                value = next(args, '')
+
+            if allowed is str:
+                settings[param] = value
+                continue
+
+            if allowed is list:
+                settings[param] = (settings[param] or []) + [value]
+                continue
+
+            if isinstance(allowed, list):
+                if value in allowed:
+                    settings[param] = value
+                else:
+                    settings[_BenchmarkParams.ERROR] = 'option {} expects one of {}, got {!r}'.format(
+                        name, ', '.join(allowed), value,
+                    )
+                continue
+
+            try:
+                settings[param] = type(allowed)(value)
+            except ValueError:
+                settings[_BenchmarkParams.ERROR] = 'option {} expects {}, got {!r}'.format(
+                    name, 'an integer' if isinstance(allowed, int) else 'a number', value,
+                )
+                continue
+
+            if settings[param] < allowed:
+                settings[_BenchmarkParams.ERROR] = 'option {} must be at least {}'.format(name, allowed)
+
+        return rest
+
+
+    def _parse_args(args=sys.argv):
+        settings = {
+            _BenchmarkParams.HELP: False,
+            _BenchmarkParams.FILES: None,
+            _BenchmarkParams.FAILED: None,
+            _BenchmarkParams.ERROR: None,
+            _BenchmarkParams.WORKER: False,
+        }
+        settings.update({param: default for param, default, _ in Benchmark.OPTIONS.values()})
+
+        if args is not None and len(args) > 1 and args[1] == Benchmark.WORKER_ARG:
+            settings[_BenchmarkParams.WORKER] = True
+            return settings
+
+        args = None if args is None else args[:1] + Benchmark._parse_options(args[1:], settings)
+
+        if args is None or len(args) <= 1:
+            settings[_BenchmarkParams.HELP] = True
+        else:
+            failed = []
+            files = []
+
+            for arg in args[1:]:
+                for path in Benchmark._find_scripts(arg.strip(), failed):
+                    if path not in files:  # Found by several arguments
+                        files.append(path)
+
+            settings[_BenchmarkParams.FILES] = files
+            settings[_BenchmarkParams.FAILED] = failed
+
+        return settings
+
+
+    def _print_help():
+        print('usage: {} [options] [files, directories or glob patterns]'.format(sys.argv[0]))
+        print(
+            Benchmark.MODULE_DESCRIPTION.format(
+                runs=Benchmark.DEFAULT_RUNS,
+                warmup=Benchmark.DEFAULT_WARMUP,
+                parallel=Benchmark.DEFAULT_PARALLEL,
+                retries=Benchmark.DEFAULT_RETRIES,
+                metrics=', '.join(Benchmark.RANK_METRICS),
+                rank_by=Benchmark.DEFAULT_RANK_BY,
+                threshold=Benchmark.DEFAULT_THRESHOLD,
+                interval=Benchmark.SAMPLING_INTERVAL * 1000,
+                profile_top=Benchmark.DEFAULT_PROFILE_TOP,
+                timeout=Benchmark.DEFAULT_TIMEOUT,
+                cache_max_age=Benchmark.DEFAULT_CACHE_MAX_AGE,
+                cache_max_size=Benchmark.DEFAULT_CACHE_MAX_SIZE,
+                min_fit_sizes=Benchmark.MIN_FIT_SIZES,
+            )
+        )
+
+
+    def _exec():
+        params = Benchmark._parse_args()
+
+        if params[_BenchmarkParams.WORKER]:
+            Benchmark._serve_worker()
+            return
+
+        if params[_BenchmarkParams.ERROR] is not None:
+            print('error: {}'.format(params[_BenchmarkParams.ERROR]))
+            Benchmark._print_help()
+            sys.exit(2)
+
+        if params[_BenchmarkParams.HELP]:
+            Benchmark._print_help()
+            return
+
+        try:
+            grid = Benchmark.make_grid(params[_BenchmarkParams.PARAMS])
+        except ValueError as e:
+            print('error: {}'.format(e))
+            sys.exit(2)
+
+        profile = params[_BenchmarkParams.PROFILE]
+        if params[_BenchmarkParams.COLLAPSED] is not None:
+            if profile == 'cprofile':
+                print('error: collapsed stacks are sampled, they cannot be written with `--profile cprofile`')
+                sys.exit(2)
+            profile = 'sampling'
+
+        Benchmark._print_failed_args(params[_BenchmarkParams.FAILED])
+        trace_alloc = params[_BenchmarkParams.TRACEMALLOC] or params[_BenchmarkParams.RANK_BY] == 'alloc'
+        res = []
+
+        for point in grid:
+            point_res = Benchmark.time(
+                params[_BenchmarkParams.FILES],
+                runs=params[_BenchmarkParams.RUNS],
+                warmup=params[_BenchmarkParams.WARMUP],
+                parallel=params[_BenchmarkParams.PARALLEL],
+                isolate=params[_BenchmarkParams.ISOLATE],
+                use_gc=not params[_BenchmarkParams.NO_GC],
+                retries=params[_BenchmarkParams.RETRIES],
+                trace_alloc=trace_alloc,
+                rank_by=params[_BenchmarkParams.RANK_BY],
+                params=point,
+                params_in_argv=params[_BenchmarkParams.PARAMS_IN_ARGV],
+                profile=profile,
+                timeout=params[_BenchmarkParams.TIMEOUT],
+                memory_limit=params[_BenchmarkParams.MEMORY_LIMIT],
+                fresh=params[_BenchmarkParams.FRESH],
+                code_cache=params[_BenchmarkParams.CODE_CACHE],
+                cache=params[_BenchmarkParams.CACHE],
+                force=params[_BenchmarkParams.FORCE],
+                on_result=lambda r, rank, n_done: print(
+                    Benchmark.progress_result(r, rank, n_done, len(params[_BenchmarkParams.FILES])),
+                    file=sys.stderr,
+                    flush=True,
+                ),
+            )
+            res += point_res
+
+            if point:
+                print('{}:'.format(Benchmark._format_params(point)))
+            print(
+                Benchmark.table_result(
+                    point_res,
+                    Benchmark.TABLE_COLUMNS + (Benchmark.ALLOC_COLUMNS if trace_alloc else []),
+                )
+            )
+            if any(r.error is not None for r in point_res):
+                print()
+                print(Benchmark.failure_result(point_res))
+            if point:
+                print()
+
+        if len(grid) > 1:
+            print(Benchmark.scaling_result(res))
+
+        if params[_BenchmarkParams.CACHE] is not None:
+            n_cached = sum(r.cached for r in res)
+            if n_cached:
+                print()
+                print('{} of {} result(s) are from the cache, use --force to measure them again'.format(
+                    n_cached, len(res),
+                ))
+            Benchmark.evict_cache(
+                params[_BenchmarkParams.CACHE],
+                params[_BenchmarkParams.CACHE_MAX_AGE],
+                params[_BenchmarkParams.CACHE_MAX_SIZE],
+            )
+
+        if trace_alloc:
+            print()
+            print(Benchmark.alloc_result(res))
+
+        if profile:
+            print()
+            print(Benchmark.profile_result(res, params[_BenchmarkParams.PROFILE_TOP]))
+        if params[_BenchmarkParams.COLLAPSED] is not None:
+            Benchmark.write_collapsed(res, params[_BenchmarkParams.COLLAPSED])
+
+        if params[_BenchmarkParams.JSON] is not None:
+            Benchmark.write_json(res, params[_BenchmarkParams.JSON])
+        if params[_BenchmarkParams.CSV] is not None:
+            Benchmark.write_csv(res, params[_BenchmarkParams.CSV])
+
+        n_regressions = 0
+        if params[_BenchmarkParams.BASELINE] is not None:
+            table, n_regressions = Benchmark.compare_with_baseline(
+                res,
+                params[_BenchmarkParams.BASELINE],
+                params[_BenchmarkParams.THRESHOLD],
+            )
+            print()
+            print(table)
+
+        # Stored after the comparison, so the store may be its own baseline
+        if params[_BenchmarkParams.STORE] is not None:
+            Benchmark.update_store(res, params[_BenchmarkParams.STORE])
+
+        n_failed = sum(r.error is not None for r in res)
+
+        if n_regressions:
+            print()
+            print('{} regression(s) beyond {}% against the baseline'.format(
+                n_regressions, params[_BenchmarkParams.THRESHOLD],
+            ))
+        if n_failed:
+            print()
+            print('{} script(s) failed'.format(n_failed))
+        if n_regressions or n_failed:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    Benchmark._exec()